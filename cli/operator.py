@@ -37,7 +37,7 @@ def generate(args) -> int:
     cls_name, io_specs, param_spec, deps = definition_cls._AbstractOperator__extract_spec_and_dependencies()
     with component_context('operators') as ctx:
         ctx[SPEC_KEY][SPEC_IOP_DECLARATION_KEY] = OrderedDict((
-            ('parameters', param_spec),
+            ('parameters', OrderedDict((name, type_.serialize()) for name, type_ in param_spec)),
             ('methods', OrderedDict(
                 [(io_method, OrderedDict((
                     ('input', OrderedDict((name, type_.serialize())
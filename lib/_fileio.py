@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+import bz2
+from contextvars import ContextVar
+import gzip
+import io
+import lzma
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from time import perf_counter
+from typing import Optional
+
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+# The object that files opened in the current context report the bytes they
+# read and the time spent waiting for them to, through its `add_io(num_bytes,
+# seconds)` method.  See lib.instrumentation.
+io_stats = ContextVar('io_stats', default=None)
+
+_COMPRESSION_BY_EXTENSION = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+}
+_COMPRESSION_BY_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+)
+_DECOMPRESSING_OPENERS = {
+    'gzip': gzip.open,
+    'bz2': bz2.open,
+    'xz': lzma.open,
+}
+
+
+def detect_compression(filename: str) -> Optional[str]:
+    """
+    Return the compression format ('gzip', 'bz2' or 'xz') of a file, based on
+    its extension or, failing that, its first bytes.  Returns None for
+    uncompressed files.
+    """
+    for extension, compression in _COMPRESSION_BY_EXTENSION.items():
+        if filename.endswith(extension):
+            return compression
+
+    with open(filename, 'rb') as f:
+        magic = f.read(6)
+    for prefix, compression in _COMPRESSION_BY_MAGIC:
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+class _CountingReader(io.RawIOBase):
+    """A raw binary stream that reports the bytes read from another one, and optionally the time."""
+
+    def __init__(self, stream, stats, timed: bool=True):
+        super().__init__()
+        self._stream = stream
+        self._stats = stats
+        self._timed = timed
+
+    def readable(self):
+        return True
+
+    def readinto(self, b) -> int:
+        if not self._timed:
+            size = self._stream.readinto(b)
+            self._stats.add_io(size or 0, 0.0)
+            return size
+
+        start = perf_counter()
+        size = self._stream.readinto(b)
+        self._stats.add_io(size or 0, perf_counter() - start)
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stream.close()
+        super().close()
+
+
+class _ThreadedReader(io.RawIOBase):
+    """
+    A raw binary stream that reads another binary stream on a background
+    thread, so that reading (and decompressing) the next chunks overlaps with
+    the processing of the previous ones.
+    """
+
+    def __init__(self, stream, chunk_size: int=DEFAULT_BUFFER_SIZE, depth: int=4, stats=None,
+                 raw=None):
+        """
+        :param stats: the object to report the time spent waiting for chunks to.
+        :param raw: the underlying file of `stream`, closed along with it if
+            `stream` does not close it itself.
+        """
+        super().__init__()
+        self._stream = stream
+        self._raw = raw
+        self._stats = stats
+        self._chunk_size = chunk_size
+        self._chunks = Queue(maxsize=depth)
+        self._stopped = Event()
+        self._chunk = memoryview(b'')
+        self._eof = False
+
+        self._thread = Thread(target=self._read_chunks, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _read_chunks(self):
+        try:
+            while True:
+                chunk = self._stream.read(self._chunk_size)
+                if not self._put(chunk) or not chunk:
+                    break
+        except BaseException as e:
+            self._put(e)
+        finally:
+            self._stream.close()
+            if self._raw is not None:
+                self._raw.close()
+
+    def readable(self):
+        return True
+
+    def _get(self):
+        if self._stats is None:
+            return self._chunks.get()
+
+        start = perf_counter()
+        item = self._chunks.get()
+        self._stats.add_io(0, perf_counter() - start)
+        return item
+
+    def readinto(self, b) -> int:
+        while not self._chunk and not self._eof:
+            item = self._get()
+            if isinstance(item, BaseException):
+                self._eof = True
+                raise item
+            if not item:
+                self._eof = True
+            self._chunk = memoryview(item)
+
+        size = min(len(b), len(self._chunk))
+        b[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stopped.set()
+            try:
+                while True:
+                    self._chunks.get_nowait()
+            except Empty:
+                pass
+        super().close()
+
+
+def open_binary(filename: str, buffer_size: int=DEFAULT_BUFFER_SIZE):
+    """
+    Open a file for reading bytes, decompressing it if it is compressed.
+    Compressed files are decompressed on a background thread.  If `io_stats`
+    is set, the (compressed) bytes read are reported to it, along with the time
+    spent waiting for them.
+    """
+    compression = detect_compression(filename)
+    stats = io_stats.get()
+    if compression is None:
+        if stats is None:
+            return open(filename, 'rb', buffering=buffer_size)
+        return io.BufferedReader(_CountingReader(open(filename, 'rb', buffering=0), stats),
+                                 buffer_size)
+
+    if stats is None:
+        raw = None
+        stream = _DECOMPRESSING_OPENERS[compression](filename, 'rb')
+    else:
+        # Bytes are counted as they are read on the background thread, but only
+        # the time spent waiting for decompressed data is reported.
+        raw = _CountingReader(open(filename, 'rb', buffering=0), stats, timed=False)
+        stream = _DECOMPRESSING_OPENERS[compression](raw, 'rb')
+    return io.BufferedReader(_ThreadedReader(stream, buffer_size, stats=stats, raw=raw),
+                             buffer_size)
+
+
+def open_text(filename: str, buffer_size: int=DEFAULT_BUFFER_SIZE, encoding: str=None,
+              newline: str=None):
+    """Open a file for reading text, decompressing it if it is compressed."""
+    return io.TextIOWrapper(open_binary(filename, buffer_size), encoding=encoding, newline=newline)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 from collections import namedtuple
+from contextvars import ContextVar
 
 from common import SingletonClass, get_hashable_dict
 
@@ -14,32 +15,75 @@ class MethodCall(namedtuple('MethodCall', ['class_', 'method', 'inputs', 'output
 StepOutputAccess = namedtuple('StepOutputAccess', ['step'])
 
 
-class PipelineStepContext(SingletonClass):
-    _in_ctx = False  # This is not thread-safe.
-    _mc_callback = None
-    _soa_callback = None
+class StepOutputReference(namedtuple('StepOutputReference', ['step', 'name', 'type_'])):
+    """
+    An output of a pipeline step, as passed to the components of later steps.
+    It is validated and hashed as its type, so that specifications are
+    unaffected, and tells executors which step output to pass.  References are
+    equal if they are to the same output of the same step object.
+    """
 
-    @property
-    def in_context(self):
-        return self._in_ctx
+    def __eq__(self, other):
+        if not isinstance(other, StepOutputReference):
+            return NotImplemented
+        return self.step is other.step and self.name == other.name and self.type_ == other.type_
 
-    def context(self, method_call_callback=None, step_output_access_callback=None):
-        self._mc_callback = method_call_callback
-        self._soa_callback = step_output_access_callback
-        return self
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash((self.name, self.type_))
+
+    def __repr__(self):
+        return '{}.output[{!r}]'.format(repr(self.step), self.name)
+
+
+class _StepContextFrame(object):
+    """A pipeline step context entered in the current thread or task."""
+    __slots__ = ('method_call_callback', 'step_output_access_callback', '_token')
+
+    def __init__(self, method_call_callback, step_output_access_callback):
+        self.method_call_callback = method_call_callback
+        self.step_output_access_callback = step_output_access_callback
+        self._token = None
 
     def __enter__(self):
-        self._in_ctx = True
+        if self._token is not None:
+            raise RuntimeError('pipeline step context already entered')
+        self._token = _current_frame.set(self)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._in_ctx = False
-        self._mc_callback = None
+        _current_frame.reset(self._token)
+        self._token = None
+
+
+# The innermost pipeline step context of the current thread or asyncio task.
+_current_frame = ContextVar('pipeline_step_context', default=None)
+
+
+class PipelineStepContext(SingletonClass):
+    """
+    The pipeline step context that calls to components are recorded in.  The
+    state of the context is kept in a context variable, so each thread and
+    asyncio task has its own, and contexts can be nested: leaving a context
+    restores the enclosing one.
+    """
+
+    @property
+    def in_context(self):
+        return _current_frame.get() is not None
+
+    def context(self, method_call_callback=None, step_output_access_callback=None):
+        return _StepContextFrame(method_call_callback, step_output_access_callback)
 
     def add_method_call_in_context(self, method_call: MethodCall):
-        if self._in_ctx and self._mc_callback is not None:
-            self._mc_callback(method_call)
+        frame = _current_frame.get()
+        if frame is not None and frame.method_call_callback is not None:
+            frame.method_call_callback(method_call)
 
     def add_step_output_access_in_context(self, step_output_access: StepOutputAccess):
-        if self._in_ctx and self._soa_callback is not None:
-            self._soa_callback(step_output_access)
+        frame = _current_frame.get()
+        if frame is not None and frame.step_output_access_callback is not None:
+            frame.step_output_access_callback(step_output_access)
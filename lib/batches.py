@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+
+"""
+Columnar record batches for Struct-typed data.
+
+A `RecordBatch` stores a number of records of a declared `Struct` type as one
+column per field instead of one dict per record.  `Int` and `Double` fields
+are stored in typed arrays (or read-only memoryviews of memory-mapped data),
+`Bool` fields are packed 8 to a byte and all other fields are stored in lists.
+"""
+
+from array import array
+from datetime import datetime
+from itertools import compress, islice
+from operator import itemgetter
+from typing import Callable, Dict, Iterable, Iterator, Sequence
+
+import lib.types as mezuri_types
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_BATCH_SIZE = 65536
+# Number of rows converted at a time by `batches_from_rows`.  Converting small
+# chunks of rows is faster than converting whole batches at once.
+CONVERSION_CHUNK_SIZE = 1024
+
+_BIT_DIGITS = bytes.maketrans(b'\x00\x01', b'01')
+
+
+class PackedBools(object):
+    """A growable sequence of booleans packed 8 to a byte."""
+    __slots__ = ('_data', '_length')
+
+    def __init__(self, values: Iterable[bool]=()):
+        self._data = bytearray()
+        self._length = 0
+        self.extend(values)
+
+    @classmethod
+    def frombytes(cls, data: bytes, length: int) -> 'PackedBools':
+        packed = cls()
+        packed._data = bytearray(data[:(length + 7) // 8])
+        packed._length = length
+        return packed
+
+    def tobytes(self) -> bytes:
+        return bytes(self._data)
+
+    def append(self, value: bool):
+        index = self._length
+        if index % 8 == 0:
+            self._data.append(0)
+        if value:
+            self._data[index // 8] |= 1 << (index % 8)
+        self._length = index + 1
+
+    def extend(self, values: Iterable[bool]):
+        if self._length % 8:
+            for value in values:
+                self.append(value)
+            return
+
+        # Pack whole bytes at once: the values, as binary digits in reverse
+        # order, are the little-endian bit representation of the packed bytes.
+        bits = bytes(map(bool, values))
+        if bits:
+            self._data += int(bits[::-1].translate(_BIT_DIGITS), 2).to_bytes((len(bits) + 7) // 8,
+                                                                             'little')
+            self._length += len(bits)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index: int) -> bool:
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('index out of range')
+        return bool(self._data[index // 8] & (1 << (index % 8)))
+
+    def __iter__(self) -> Iterator[bool]:
+        data = self._data
+        for index in range(self._length):
+            yield bool(data[index // 8] & (1 << (index % 8)))
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, list(self))
+
+
+def record_struct(type_: mezuri_types.AbstractMezuriSerializable) -> mezuri_types.Struct:
+    """Return the Struct type of the records of a Struct, or of a List or Stream of Structs."""
+    if isinstance(type_, mezuri_types.List):
+        type_ = type_.element_type
+    if not isinstance(type_, mezuri_types.Struct):
+        raise TypeError('{} is not a Struct type or a List or Stream of Structs'.format(type_))
+    return type_
+
+
+def _typecode(column) -> str:
+    # Typed columns are arrays, or memoryviews of memory-mapped data.
+    return column.typecode if isinstance(column, array) else column.format
+
+
+def new_column(type_: mezuri_types.AbstractMezuriSerializable):
+    """Return an empty column for values of a type."""
+    if type_ is mezuri_types.Int():
+        return array('q')
+    if type_ is mezuri_types.Double():
+        return array('d')
+    if type_ is mezuri_types.Bool():
+        return PackedBools()
+    return []
+
+
+_BOOL_STRINGS = dict([(s, True) for s in ('true', 't', 'yes', 'y', '1')] +
+                     [(s, False) for s in ('false', 'f', 'no', 'n', '0', '')])
+
+
+def parse_bool(value: str) -> bool:
+    result = _BOOL_STRINGS.get(value.strip().lower(), None)
+    if result is None:
+        raise ValueError('invalid boolean value: {!r}'.format(value))
+    return result
+
+
+def value_parser(type_: mezuri_types.AbstractMezuriSerializable) -> Callable[[str], object]:
+    """Return the function that converts the string form of a value to a value of a type."""
+    if type_ is mezuri_types.Int():
+        return int
+    if type_ is mezuri_types.Double():
+        return float
+    if type_ is mezuri_types.Bool():
+        return parse_bool
+    if type_ is mezuri_types.Datetime():
+        return datetime.fromisoformat
+    return str
+
+
+def column_from_strings(type_: mezuri_types.AbstractMezuriSerializable, values: Iterable[str]):
+    """Convert the string forms of a whole column of values of a type at once."""
+    parser = value_parser(type_)
+    if type_ is mezuri_types.Int():
+        return array('q', map(parser, values))
+    if type_ is mezuri_types.Double():
+        return array('d', map(parser, values))
+    if type_ is mezuri_types.Bool():
+        values = list(values)
+        # Look canonical strings up directly and only normalize if some are not.
+        bools = list(map(_BOOL_STRINGS.get, values))
+        if None in bools:
+            bools = list(map(parser, values))
+        return PackedBools(bools)
+    return list(map(parser, values))
+
+
+def column_from_values(type_: mezuri_types.AbstractMezuriSerializable, values: Iterable):
+    """
+    Build a whole column from values that already have the Python types of a
+    type, as produced by JSON or database drivers.  Datetimes given as ISO 8601
+    strings are parsed.
+    """
+    if type_ is mezuri_types.Int():
+        return array('q', values)
+    if type_ is mezuri_types.Double():
+        return array('d', values)
+    if type_ is mezuri_types.Bool():
+        return PackedBools(values)
+    if type_ is mezuri_types.Datetime():
+        return [datetime.fromisoformat(value) if isinstance(value, str) else value
+                for value in values]
+    return list(values)
+
+
+class RecordBatch(object):
+    """A batch of records of a Struct type, stored column by column."""
+
+    def __init__(self, struct_type: mezuri_types.AbstractMezuriSerializable, columns: Dict=None):
+        self.struct_type = record_struct(struct_type)
+        self.field_names = tuple(self.struct_type.definition)
+        if columns is None:
+            columns = {name: new_column(type_) for name, type_ in self.struct_type.definition.items()}
+        self.columns = columns
+
+    @classmethod
+    def from_rows(cls, struct_type: mezuri_types.AbstractMezuriSerializable,
+                  header: Sequence[str], rows: Sequence[Sequence],
+                  column_builder: Callable=column_from_strings) -> 'RecordBatch':
+        """
+        Build a batch from rows, converting each column of the Struct type as a
+        whole.  By default rows are expected to be strings, such as those
+        produced by a CSV reader; use `column_from_values` for rows of values.
+        Columns in `header` that are not fields of the Struct type are skipped.
+        """
+        struct_type = record_struct(struct_type)
+        positions = {name: position for position, name in enumerate(header)}
+        columns = {}
+        for name, type_ in struct_type.definition.items():
+            if name not in positions:
+                raise KeyError('field {} is not in the header'.format(name))
+            columns[name] = column_builder(type_, map(itemgetter(positions[name]), rows))
+        return cls(struct_type, columns)
+
+    @classmethod
+    def from_records(cls, struct_type: mezuri_types.AbstractMezuriSerializable,
+                     records: Iterable[Dict]) -> 'RecordBatch':
+        """Build a batch from dicts of values, converting each column as a whole."""
+        struct_type = record_struct(struct_type)
+        records = records if isinstance(records, list) else list(records)
+        return cls(struct_type, {name: column_from_values(type_, map(itemgetter(name), records))
+                                 for name, type_ in struct_type.definition.items()})
+
+    def append(self, record: Dict):
+        for name in self.field_names:
+            self.columns[name].append(record[name])
+
+    def extend(self, records: Iterable[Dict]):
+        columns = [(name, self.columns[name]) for name in self.field_names]
+        for record in records:
+            for name, column in columns:
+                column.append(record[name])
+
+    def extend_batch(self, batch: 'RecordBatch'):
+        """Append the records of another batch of the same Struct type."""
+        if batch.struct_type is not self.struct_type:
+            raise TypeError('cannot extend a batch of {} with a batch of {}'.format(
+                self.struct_type, batch.struct_type))
+        for name in self.field_names:
+            self.columns[name].extend(batch.columns[name])
+
+    def select(self, names: Sequence[str]) -> 'RecordBatch':
+        """Return a batch with only some of the fields, sharing their columns."""
+        struct_type = mezuri_types.Struct({name: self.struct_type.definition[name] for name in names})
+        return type(self)(struct_type, {name: self.columns[name] for name in names})
+
+    def filter(self, mask: Sequence[bool]) -> 'RecordBatch':
+        """Return a batch with only the records for which `mask` is true."""
+        columns = {}
+        for name in self.field_names:
+            column = self.columns[name]
+            if isinstance(column, (array, memoryview)):
+                columns[name] = array(_typecode(column), compress(column, mask))
+            elif isinstance(column, PackedBools):
+                columns[name] = PackedBools(compress(column, mask))
+            else:
+                columns[name] = list(compress(column, mask))
+        return type(self)(self.struct_type, columns)
+
+    def slice(self, start: int, stop: int) -> 'RecordBatch':
+        """Return a batch of the records from `start` to `stop`."""
+        columns = {}
+        for name in self.field_names:
+            column = self.columns[name]
+            if isinstance(column, PackedBools):
+                columns[name] = PackedBools(map(column.__getitem__,
+                                                range(start, min(stop, len(column)))))
+            else:
+                columns[name] = column[start:stop]
+        return type(self)(self.struct_type, columns)
+
+    def column(self, name: str):
+        return self.columns[name]
+
+    def __len__(self):
+        if not self.field_names:
+            return 0
+        return len(self.columns[self.field_names[0]])
+
+    def __iter__(self) -> Iterator[Dict]:
+        names = self.field_names
+        for values in zip(*(self.columns[name] for name in names)):
+            yield dict(zip(names, values))
+
+    def __repr__(self):
+        return '{}({}, {} records)'.format(self.__class__.__name__, repr(self.struct_type), len(self))
+
+    def to_records(self):
+        return list(self)
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate size of the column buffers in bytes."""
+        size = 0
+        for column in self.columns.values():
+            if isinstance(column, (array, memoryview)):
+                size += column.itemsize * len(column)
+            elif isinstance(column, PackedBools):
+                size += (len(column) + 7) // 8
+            else:
+                size += 8 * len(column)
+        return size
+
+    def to_numpy(self) -> Dict:
+        """
+        Return the columns as NumPy arrays.  Typed array columns are shared
+        with the batch instead of being copied.
+        """
+        if numpy is None:
+            raise RuntimeError('NumPy is not available.')
+
+        result = {}
+        for name in self.field_names:
+            column = self.columns[name]
+            if isinstance(column, (array, memoryview)):
+                dtype = 'i8' if _typecode(column) == 'q' else 'f8'
+                result[name] = numpy.frombuffer(column, dtype=dtype)
+            elif isinstance(column, PackedBools):
+                bits = numpy.unpackbits(numpy.frombuffer(column.tobytes(), dtype='u1'),
+                                        bitorder='little')
+                result[name] = bits[:len(column)].astype(bool)
+            else:
+                array_ = numpy.empty(len(column), dtype=object)
+                array_[:] = column
+                result[name] = array_
+        return result
+
+
+def _chunked_batches(struct_type: mezuri_types.Struct, items: Iterable,
+                     build: Callable[[list], RecordBatch], batch_size: int) -> Iterator[RecordBatch]:
+    items = iter(items)
+    batch = RecordBatch(struct_type)
+    while True:
+        chunk = list(islice(items, min(CONVERSION_CHUNK_SIZE, batch_size - len(batch))))
+        if not chunk:
+            break
+
+        batch.extend_batch(build(chunk))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = RecordBatch(struct_type)
+
+    if len(batch):
+        yield batch
+
+
+def batches(struct_type: mezuri_types.AbstractMezuriSerializable, records: Iterable[Dict],
+            batch_size: int=DEFAULT_BATCH_SIZE) -> Iterator[RecordBatch]:
+    """
+    Group dicts of values into batches of at most `batch_size` records,
+    converting the records in chunks of `CONVERSION_CHUNK_SIZE` a column at a time.
+    """
+    struct_type = record_struct(struct_type)
+    return _chunked_batches(struct_type, records,
+                            lambda chunk: RecordBatch.from_records(struct_type, chunk), batch_size)
+
+
+def batches_from_rows(struct_type: mezuri_types.AbstractMezuriSerializable, header: Sequence[str],
+                      rows: Iterable[Sequence], batch_size: int=DEFAULT_BATCH_SIZE,
+                      column_builder: Callable=column_from_strings) -> Iterator[RecordBatch]:
+    """
+    Convert rows into batches of at most `batch_size` records, converting the
+    rows in chunks of `CONVERSION_CHUNK_SIZE` a column at a time.
+    """
+    struct_type = record_struct(struct_type)
+    return _chunked_batches(struct_type, rows,
+                            lambda chunk: RecordBatch.from_rows(struct_type, header, chunk,
+                                                                column_builder),
+                            batch_size)
+
+
+def rebatch(batches_: Iterable[RecordBatch], batch_size: int) -> Iterator[RecordBatch]:
+    """
+    Split and join batches of the same Struct type into batches of
+    `batch_size` records, except for the last one.  Parts of batches that
+    make up a whole batch are slices of them.
+    """
+    pending = None
+    for batch in batches_:
+        start = 0
+        if pending is not None:
+            start = batch_size - len(pending)
+            pending.extend_batch(batch.slice(0, start))
+            if len(pending) < batch_size:
+                continue
+            yield pending
+            pending = None
+
+        while len(batch) - start >= batch_size:
+            yield batch.slice(start, start + batch_size)
+            start += batch_size
+        if start < len(batch):
+            pending = RecordBatch(batch.struct_type)
+            pending.extend_batch(batch.slice(start, len(batch)))
+
+    if pending is not None:
+        yield pending
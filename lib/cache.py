@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+"""
+Local materialization cache for source reader output.
+
+Parsed output is stored as record batches in a compact binary columnar file,
+keyed by the reader class, `uri`, `query`, pushdown and output type of the
+reader and a fingerprint of the file it reads.  Typed columns of cached files
+are memory-mapped back instead of being parsed again.
+
+Cache file layout:
+
+    magic        b'MZC\x01'
+    type         u32 length, then the output Struct type encoded by lib.encoding
+    batches      for each batch: u64 number of records, then for each field
+                 u64 length and the column data, padded to 8 bytes
+
+Int and Double columns are stored as native machine values, Bool columns as
+packed bits and other columns as JSON arrays (Datetimes in ISO 8601 form).
+"""
+
+from array import array
+from datetime import datetime
+from hashlib import sha256
+from itertools import chain
+import json
+import mmap
+import os
+import struct
+from tempfile import mkstemp
+from typing import Iterable, Iterator, Optional
+
+from lib.batches import DEFAULT_BATCH_SIZE, PackedBools, RecordBatch, rebatch, record_struct
+from lib.definitions import AbstractSourceReader, SourceReaderWrapper
+from lib.encoding import decode, encode
+import lib.types as mezuri_types
+
+MAGIC = b'MZC\x01'
+CACHE_FILE_EXTENSION = '.mzc'
+
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
+
+
+def local_path(uri: str) -> Optional[str]:
+    """Return the path of the local file a `scheme://path` URI refers to, if there is one."""
+    _, separator, path = uri.partition('://')
+    if separator and os.path.isfile(path):
+        return path
+    return None
+
+
+def file_fingerprint(path: str, full_hash: bool=False) -> str:
+    """
+    A cheap fingerprint of the contents of a file: its size and modification
+    time and, optionally, a hash of its contents.
+    """
+    stat = os.stat(path)
+    fingerprint = '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+    if full_hash:
+        digest = sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        fingerprint += ':' + digest.hexdigest()
+    return fingerprint
+
+
+def _column_bytes(type_: mezuri_types.AbstractMezuriSerializable, column) -> bytes:
+    if type_ is mezuri_types.Int() or type_ is mezuri_types.Double():
+        return column.tobytes() if isinstance(column, array) else bytes(column)
+    if type_ is mezuri_types.Bool():
+        return column.tobytes()
+    if type_ is mezuri_types.Datetime():
+        column = [value.isoformat() for value in column]
+    return json.dumps(list(column), separators=(',', ':')).encode()
+
+
+def _column_from_bytes(type_: mezuri_types.AbstractMezuriSerializable, data: memoryview,
+                       num_records: int):
+    if type_ is mezuri_types.Int():
+        return data.cast('q')
+    if type_ is mezuri_types.Double():
+        return data.cast('d')
+    if type_ is mezuri_types.Bool():
+        return PackedBools.frombytes(data, num_records)
+    values = json.loads(bytes(data).decode())
+    if type_ is mezuri_types.Datetime():
+        values = [datetime.fromisoformat(value) for value in values]
+    return values
+
+
+def _write_header(f, struct_type: mezuri_types.Struct):
+    encoded_type = encode(struct_type)
+    f.write(MAGIC)
+    f.write(_U32.pack(len(encoded_type)))
+    f.write(encoded_type)
+    f.write(b'\0' * (-f.tell() % 8))
+
+
+def _write_batch(f, batch: RecordBatch):
+    f.write(_U64.pack(len(batch)))
+    for name, type_ in batch.struct_type.definition.items():
+        data = _column_bytes(type_, batch.column(name))
+        f.write(_U64.pack(len(data)))
+        f.write(data)
+        f.write(b'\0' * (-len(data) % 8))
+
+
+def write_batches(f, struct_type: mezuri_types.Struct, batches: Iterable[RecordBatch]):
+    """Write batches of a Struct type to a binary file in the cache file format."""
+    _write_header(f, struct_type)
+    for batch in batches:
+        _write_batch(f, batch)
+
+
+def read_batches(path: str) -> Iterator[RecordBatch]:
+    """
+    Read the batches of a cache file.  Int and Double columns are memoryviews
+    of the memory-mapped file.
+    """
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    data = memoryview(mm)
+    if data[:len(MAGIC)] != MAGIC:
+        raise RuntimeError('{} is not a cache file.'.format(path))
+
+    offset = len(MAGIC)
+    type_length, = _U32.unpack_from(data, offset)
+    offset += _U32.size
+    struct_type = decode(bytes(data[offset:offset + type_length]))
+    offset += type_length
+    offset += -offset % 8
+
+    while offset < len(data):
+        num_records, = _U64.unpack_from(data, offset)
+        offset += _U64.size
+        columns = {}
+        for name, type_ in struct_type.definition.items():
+            length, = _U64.unpack_from(data, offset)
+            offset += _U64.size
+            columns[name] = _column_from_bytes(type_, data[offset:offset + length], num_records)
+            offset += length + (-length % 8)
+        yield RecordBatch(struct_type, columns)
+
+
+class SourceCache(object):
+    """
+    A directory of cached source reader output, evicting the least recently
+    used entries when the total size exceeds `max_bytes`.
+    """
+
+    def __init__(self, directory: str, max_bytes: int=1 << 30, full_hash: bool=False):
+        """
+        :param directory: the directory to store cache files in.
+        :param max_bytes: the disk budget of the cache.
+        :param full_hash: whether to hash the contents of source files, in
+            addition to checking their size and modification time.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.full_hash = full_hash
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, reader: AbstractSourceReader, struct_type: mezuri_types.Struct) -> Optional[str]:
+        """Return the cache key for the output of a reader, or None if it cannot be cached."""
+        path = local_path(reader.uri)
+        if path is None:
+            return None
+
+        pushdown = reader.pushdown
+        key = json.dumps([
+            '{}.{}'.format(type(reader).__module__, type(reader).__qualname__),
+            reader.uri,
+            reader.query,
+            file_fingerprint(path, self.full_hash),
+            struct_type.layout,
+            None if pushdown is None else [
+                sorted(pushdown.columns) if pushdown.columns is not None else None,
+                [repr(predicate) for predicate in pushdown.predicates]
+            ],
+        ])
+        return sha256(key.encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + CACHE_FILE_EXTENSION)
+
+    def get(self, key: str) -> Optional[Iterator[RecordBatch]]:
+        """Return the cached batches for a key, or None if there are none."""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return read_batches(path)
+
+    def put(self, key: str, struct_type: mezuri_types.Struct,
+            batches: Iterable[RecordBatch]) -> Iterator[RecordBatch]:
+        """
+        Cache batches while yielding them.  The entry is only added once all
+        batches have been consumed.
+        """
+        fd, temporary_path = mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                _write_header(f, struct_type)
+                for batch in batches:
+                    _write_batch(f, batch)
+                    yield batch
+            os.replace(temporary_path, self.path(key))
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        self.evict()
+
+    def size(self) -> int:
+        return sum(os.path.getsize(path) for path, _ in self._entries())
+
+    def _entries(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(CACHE_FILE_EXTENSION):
+                path = os.path.join(self.directory, name)
+                try:
+                    yield path, os.stat(path)
+                except FileNotFoundError:
+                    pass
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in its budget."""
+        entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime_ns)
+        total = sum(stat.st_size for _, stat in entries)
+        for path, stat in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= stat.st_size
+
+
+class CachedReader(SourceReaderWrapper):
+    """
+    A reader that reads the output of another reader through a `SourceCache`.
+    Output is read and cached as record batches of the reader's output type,
+    and cached batches are split or joined into batches of the requested
+    size.  Records are read from the cached batches when the reader can map
+    them to the records it reads; readers of sources without a local file,
+    and readers that cannot, are read directly.
+    """
+
+    def __init__(self, reader: AbstractSourceReader, cache: SourceCache):
+        super().__init__(reader)
+        self.cache = cache
+
+    def read(self, query: str=None):
+        mapper = self.reader.typed_record_mapper()
+        if mapper is None or query not in (None, self.query):
+            return self.reader.read(query if query is not None else self.query)
+        return map(mapper, chain.from_iterable(self.read_batches(query)))
+
+    def read_batches(self, query: str=None, struct_type=None,
+                     batch_size: int=DEFAULT_BATCH_SIZE) -> Iterator[RecordBatch]:
+        struct_type = self._batch_struct(struct_type)
+        query = query if query is not None else self.query
+
+        key = None
+        if query == self.query:
+            key = self.cache.key(self.reader, record_struct(struct_type))
+        if key is None:
+            return self.reader.read_batches(query, struct_type, batch_size)
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            return rebatch(cached, batch_size)
+
+        batches = self.reader.read_batches(query, struct_type, batch_size)
+        if self.pushdown is not None:
+            struct_type = self.pushdown.read_struct(struct_type, include_predicate_fields=False)
+        return self.cache.put(key, record_struct(struct_type), batches)
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 from typing import Dict, Callable, Tuple
 
 from . import PipelineError
-from ._pipelinecontext import MethodCall, PipelineStepContext
+from ._pipelinecontext import MethodCall, PipelineStepContext, StepOutputReference
 from common import ComponentInfo, SPEC_DEFINITION_KEY, SPEC_IOP_DECLARATION_KEY
 from common.registry import RegistryClient
 import lib.types as mezuri_types
@@ -13,6 +14,66 @@ PARAM_METHOD_DECLARATION_ATTR = '__mezuri_param_method__'
 IO_METHOD_DECLARATION_ATTR = '__mezuri_io_method__'
 
 
+def _deserialized_method_specs(method_specs: Dict) -> Dict:
+    """Return a copy of method specifications with input and output types deserialized."""
+    deserialized = OrderedDict(method_specs)
+    for key in ('input', 'output'):
+        if key in method_specs:
+            deserialized[key] = OrderedDict((name, mezuri_types.get_deserialized(type_))
+                                            for name, type_ in method_specs[key].items())
+    return deserialized
+
+
+def _argument_fingerprint(value):
+    if isinstance(value, StepOutputReference):
+        value = value.type_
+    if isinstance(value, mezuri_types.AbstractMezuriSerializable):
+        return value.fingerprint
+    return value
+
+
+class ArgumentsValidator(object):
+    """
+    Validator for the keyword arguments of a call to a component or one of its
+    methods.  The expected names and type fingerprints are computed once from
+    the specifications, and all mismatches of a call are reported together.
+
+    The output of an earlier step may also be passed for an argument whose
+    type is a projection of its type (see `lib.types.is_projection`): the
+    fields the argument declares are all that the step consumes of it.
+    """
+
+    def __init__(self, description: str, specs: Dict[str, mezuri_types.AbstractMezuriSerializable]):
+        self._description = description
+        self._specs = specs
+        self._names = frozenset(specs)
+        self._fingerprints = {name: _argument_fingerprint(type_) for name, type_ in specs.items()}
+
+    def __call__(self, kwargs: Dict):
+        fingerprints = self._fingerprints
+        errors = []
+        num_expected = 0
+        for name, value in kwargs.items():
+            fingerprint = fingerprints.get(name, None)
+            if fingerprint is None:
+                errors.append("unexpected argument '{}'".format(name))
+                continue
+
+            num_expected += 1
+            if _argument_fingerprint(value) != fingerprint and not (
+                    isinstance(value, StepOutputReference) and
+                    mezuri_types.is_projection(self._specs[name], value.type_)):
+                errors.append("type of argument '{}' does not match".format(name))
+
+        if num_expected != len(self._names):
+            errors.extend("missing argument '{}'".format(name)
+                          for name in sorted(self._names.difference(kwargs)))
+
+        if errors:
+            raise PipelineError('{} do not match specifications: {}'.format(
+                self._description, '; '.join(errors)))
+
+
 class AbstractComponentProxyFactory(mezuri_types.AbstractMezuriSerializable):
     data_type = 'ABSTRACT_COMPONENT'
 
@@ -29,6 +90,8 @@ class AbstractComponentProxyFactory(mezuri_types.AbstractMezuriSerializable):
 
         self._specs = None
         self._version_hash = None
+        self._method_proxies = {}
+        self._parameters_validator = None
 
     def __repr__(self):
         if self._specs is None:
@@ -76,6 +139,35 @@ class AbstractComponentProxyFactory(mezuri_types.AbstractMezuriSerializable):
             self._fetch_spec_and_version_hash()
         return self._version_hash
 
+    @property
+    def _method_declarations(self) -> Dict:
+        """Raw (serialized) specifications of the methods of this component."""
+        return {}
+
+    def _method_proxy(self, method_name: str) -> 'AbstractComponentProxyFactory.ComponentMethodProxy':
+        """
+        Return the proxy for a method of this component.  Proxies are built
+        from deserialized copies of the method specifications the first time
+        they are requested and reused afterwards, so the raw specifications
+        fetched from the registry are never modified.
+        """
+        method_proxy = self._method_proxies.get(method_name, None)
+        if method_proxy is None:
+            method_specs = self._method_declarations.get(method_name, None)
+            if method_specs is None:
+                raise AttributeError('{} has no output method {}'.format(
+                    self.specs[SPEC_DEFINITION_KEY]['class'], method_name))
+
+            method_proxy = self._method_proxy_class(self, method_name,
+                                                    _deserialized_method_specs(method_specs))
+            self._method_proxies[method_name] = method_proxy
+        return method_proxy
+
+    def method_proxies(self) -> Dict[str, 'AbstractComponentProxyFactory.ComponentMethodProxy']:
+        """Build (if required) and return the proxies for all methods of this component."""
+        return {method_name: self._method_proxy(method_name)
+                for method_name in self._method_declarations}
+
     @abstractmethod
     def __call__(self, **kwargs):
         if not PipelineStepContext().in_context:
@@ -91,6 +183,8 @@ class AbstractComponentProxyFactory(mezuri_types.AbstractMezuriSerializable):
             self._proxy = proxy
             self._method_name = method_name
             self._method_specs = method_specs
+            self._validate_inputs = ArgumentsValidator(
+                "arguments to method '{}'".format(method_name), method_specs.get('input', {}))
 
         def __repr__(self):
             return '{}.{}'.format(repr(self._proxy), self._method_name)
@@ -99,21 +193,14 @@ class AbstractComponentProxyFactory(mezuri_types.AbstractMezuriSerializable):
             if not PipelineStepContext().in_context:
                 raise PipelineError('{} can only be called in a pipeline step context'.format(str(self)))
 
-            input_specs = self._method_specs.get('input', {})
-            if set(input_kwargs) != set(input_specs):
-                raise PipelineError("arguments to method '{}' do not match method input "
-                                    "specifications".format(self._method_name))
-
-            for name, type_ in input_kwargs.items():
-                if type_ != input_specs[name]:
-                    raise PipelineError("type of argument '{}' to method {} does not match "
-                                        "method input specifications".format(name, self._method_name))
-
+            self._validate_inputs(input_kwargs)
             PipelineStepContext().add_method_call_in_context(MethodCall(
                 self._proxy, self._method_name, input_kwargs, self._method_specs['output']
             ))
             return self._method_specs['output']
 
+    _method_proxy_class = ComponentMethodProxy
+
 
 class SourceProxyFactory(AbstractComponentProxyFactory):
     data_type = 'SOURCE'
@@ -122,48 +209,44 @@ class SourceProxyFactory(AbstractComponentProxyFactory):
     def __call__(self, **kwargs):
         return super().__call__(**kwargs)
 
-    def __getattr__(self, method_name: str):
-        method_specs = self.specs[SPEC_IOP_DECLARATION_KEY].get(method_name, None)
-        if method_specs is None:
-            raise AttributeError('{} has no output method {}'.format(
-                self.specs[SPEC_DEFINITION_KEY]['class'], method_name))
+    @property
+    def _method_declarations(self):
+        return self.specs[SPEC_IOP_DECLARATION_KEY]
 
-        method_specs['output'] = {k: mezuri_types.get_deserialized(v)
-                                  for k, v in method_specs['output'].items()}
-        return self.SourceMethodProxy(self, method_name, method_specs)
+    def __getattr__(self, method_name: str):
+        if method_name.startswith('_'):
+            raise AttributeError(method_name)
+        return self._method_proxy(method_name)
 
     class SourceMethodProxy(AbstractComponentProxyFactory.ComponentMethodProxy):
         def __call__(self):
             return super().__call__()
 
+    _method_proxy_class = SourceMethodProxy
+
 
 class OperatorProxyFactory(AbstractComponentProxyFactory):
     data_type = 'OPERATOR'
     component_type = 'operators'
 
     def __call__(self, **kwargs):
-        param_specs = self.specs[SPEC_IOP_DECLARATION_KEY]['parameters']
-        if set(kwargs.keys()) != set(param_specs):
-            raise PipelineError('arguments to __init__ do not match parameter specifications')
-
-        for name, type_ in kwargs.items():
-            if type_ != param_specs[name]:
-                raise PipelineError("type of argument '{}' does not match parameter "
-                                    "specifications".format(name))
+        if self._parameters_validator is None:
+            param_specs = OrderedDict(self.specs[SPEC_IOP_DECLARATION_KEY]['parameters'])
+            self._parameters_validator = ArgumentsValidator(
+                'arguments to __init__',
+                {name: mezuri_types.get_deserialized(type_) for name, type_ in param_specs.items()})
+        self._parameters_validator(kwargs)
 
         return super().__call__(**kwargs)
 
-    def __getattr__(self, method_name: str):
-        method_specs = self.specs[SPEC_IOP_DECLARATION_KEY]['methods'].get(method_name, None)
-        if method_specs is None:
-            raise AttributeError('{} has no output method {}'.format(
-                self.specs[SPEC_DEFINITION_KEY]['class'], method_name))
+    @property
+    def _method_declarations(self):
+        return self.specs[SPEC_IOP_DECLARATION_KEY]['methods']
 
-        method_specs['input'] = {k: mezuri_types.get_deserialized(v)
-                                 for k, v in method_specs['input'].items()}
-        method_specs['output'] = {k: mezuri_types.get_deserialized(v)
-                                  for k, v in method_specs['output'].items()}
-        return super().ComponentMethodProxy(self, method_name, method_specs)
+    def __getattr__(self, method_name: str):
+        if method_name.startswith('_'):
+            raise AttributeError(method_name)
+        return self._method_proxy(method_name)
 
 
 class InterfaceProxyFactory(AbstractComponentProxyFactory):
@@ -200,6 +283,7 @@ class AbstractIOP(metaclass=ABCMeta):
 DECLARATION_ATTR_INPUT_KEY = '__input__'
 DECLARATION_ATTR_OUTPUT_KEY = '__output__'
 DECLARATION_ATTR_PARAMETER_KEY = '__parameter__'
+DECLARATION_ATTR_READS_FROM_KEY = '__reads_from__'
 
 
 class Input(AbstractIOP):
@@ -217,11 +301,36 @@ class Parameter(AbstractIOP):
     _attr_io_key = DECLARATION_ATTR_PARAMETER_KEY
 
 
+class ReadsFrom(object):
+    """
+    Declares the `uri` and `query` of the reader returned by an output method
+    of a source, so that its specifications can be generated without
+    instantiating the source or calling the method.
+    """
+
+    def __init__(self, uri: str, query: str):
+        self.uri = uri
+        self.query = query
+
+    def __call__(self, method: Callable):
+        setattr(method, DECLARATION_ATTR_READS_FROM_KEY, (self.uri, self.query))
+        return method
+
+
+DEFINITION_MODULE_NAME = '__mezuri_definition__'
+
+
 def extract_component_definition(definition_file: str, definition_class: str):
+    """
+    Evaluate a definition file and return the class it refers to as
+    `definition_class`.  The file is evaluated as a module named
+    `DEFINITION_MODULE_NAME`, so that code that should only run when it is
+    executed directly can be guarded by `if __name__ == '__main__'`.
+    """
     with open(definition_file) as f:
         contents = f.read()
 
-    globals_ = {}
-    exec(contents, globals_)
+    globals_ = {'__name__': DEFINITION_MODULE_NAME, '__file__': definition_file}
+    exec(compile(contents, definition_file, 'exec'), globals_)
 
     return globals_.get(definition_class, None)
@@ -1,13 +1,29 @@
 #!/usr/bin/env python3
 
 from abc import ABCMeta, abstractmethod
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 import csv
-from itertools import chain
-from typing import Optional, Callable, Dict, Generic, TypeVar, Sequence
-
+from io import StringIO
+from itertools import chain, islice
+import json
+import mmap
+import os
+import sqlite3
+from typing import Optional, Callable, Dict, Generic, Iterable, Iterator, List, TypeVar, Sequence
+from urllib.request import pathname2url
+
+from lib._fileio import detect_compression, open_text
+from lib.batches import (
+    DEFAULT_BATCH_SIZE, RecordBatch, batches, batches_from_rows, column_from_values, record_struct,
+    value_parser
+)
+from lib.pushdown import Predicate, Pushdown
+from lib.records import has_record_class, record_class, record_mapper, row_parser
 from lib.declarations import (
     PARAM_METHOD_DECLARATION_ATTR, IO_METHOD_DECLARATION_ATTR,
-    DECLARATION_ATTR_INPUT_KEY, DECLARATION_ATTR_OUTPUT_KEY, DECLARATION_ATTR_PARAMETER_KEY
+    DECLARATION_ATTR_INPUT_KEY, DECLARATION_ATTR_OUTPUT_KEY, DECLARATION_ATTR_PARAMETER_KEY,
+    DECLARATION_ATTR_READS_FROM_KEY
 )
 
 
@@ -99,30 +115,52 @@ class AbstractSource(AbstractComponent, metaclass=ABCMeta):
         @Output('output2', OutputType2)
         def method_name(self) -> SourceReader:
             ...
-    ```    
+    ```
+
+    The `uri` and `query` of the reader returned by an output method can be
+    declared with `ReadsFrom`, in which case specifications are generated
+    without instantiating the source or calling the method:
+    ```
+    from .declarations import Output, ReadsFrom
+
+    class Source(AbstractSource):
+        @ReadsFrom('file://data.csv', 'read')
+        @Output('output1', OutputType1)
+        def method_name(self) -> SourceReader:
+            ...
+    ```
     """
 
     @classmethod
     def __extract_spec_and_dependencies(cls):
         """
-        Extract specifications for this source.
+        Extract specifications for this source.  The source is only
+        instantiated, and its output methods only called, for methods whose
+        reader `uri` and `query` are not declared with `ReadsFrom`.
 
         This method is part of the internal API and is not meant to be used
         by end-users.
         """
         specs = {}
         dependencies = set()
-        cls_inst = cls()
+        cls_inst = None
         for var_name, var in vars(cls).items():
             if hasattr(var, '__get__'):
-                bound_var = var.__get__(cls_inst, cls)
-                if getattr(bound_var, IO_METHOD_DECLARATION_ATTR, False):
-                    output = getattr(bound_var, DECLARATION_ATTR_OUTPUT_KEY, tuple())
-                    reader = bound_var()
+                unbound_var = var.__get__(None, cls)
+                if getattr(unbound_var, IO_METHOD_DECLARATION_ATTR, False):
+                    output = getattr(unbound_var, DECLARATION_ATTR_OUTPUT_KEY, tuple())
+                    reads_from = getattr(unbound_var, DECLARATION_ATTR_READS_FROM_KEY, None)
+                    if reads_from is None:
+                        if cls_inst is None:
+                            cls_inst = cls()
+                        reader = var.__get__(cls_inst, cls)()
+                        reads_from = reader.uri, reader.query
+
+                    uri, query = reads_from
                     specs[var_name] = {
                         'output': output,
-                        'uri': reader.uri,
-                        'query': reader.query
+                        'uri': uri,
+                        'query': query
                     }
 
                     for _, type_ in output:
@@ -141,6 +179,13 @@ class AbstractSourceReader(Generic[SourceOutput], metaclass=ABCMeta):
     obtain source output and generate definitions.
     """
 
+    # The declared Struct type of the records produced by this reader, if known.
+    output_type = None
+    # The projection and predicates pushed down into this reader, if any.
+    pushdown = None
+    # Whether this reader applies `pushdown` when reading.
+    supports_pushdown = False
+
     @property
     @abstractmethod
     def uri(self):
@@ -179,20 +224,115 @@ class AbstractSourceReader(Generic[SourceOutput], metaclass=ABCMeta):
         """
         pass
 
+    def push_down(self, columns: Iterable[str]=None, predicates: Iterable[Predicate]=()) -> bool:
+        """
+        Ask this reader to only produce the given columns (all if None) of the
+        records that satisfy all predicates.  Returns whether the reader
+        supports pushdown; readers that do not ignore it, and their output must
+        be filtered and projected by the caller.
+        """
+        if not self.supports_pushdown:
+            return False
+
+        self.pushdown = Pushdown(columns, predicates)
+        return True
+
+    def _batch_struct(self, struct_type=None):
+        """
+        Return the Struct type to read batches of: `struct_type`, or the
+        `output_type` of this reader if it is None.
+        """
+        struct_type = struct_type if struct_type is not None else self.output_type
+        if struct_type is None:
+            raise RuntimeError('A Struct type is required to read batches from {}.'.format(self))
+        return struct_type
+
+    def read_batches(self, query: str=None, struct_type=None,
+                     batch_size: int=DEFAULT_BATCH_SIZE) -> Iterator[RecordBatch]:
+        """
+        Returns the output for this source as columnar record batches.  The
+        records are expected to be dicts with values of the Python types that
+        correspond to the fields of `struct_type`, which defaults to the
+        `output_type` of this reader.  Readers that can produce columns directly
+        should override this method.
+        """
+        struct_type = self._batch_struct(struct_type)
+        return batches(struct_type, self.read(query if query is not None else self.query), batch_size)
+
+    def typed_record_mapper(self) -> Optional[Callable[[Dict], SourceOutput]]:
+        """
+        Returns the function that maps the dicts of typed values in the
+        batches of `output_type` read from this reader to the records returned
+        by `read`, or None if `read` does not return records of its output
+        type.  Readers that cache batches use it to return the same records.
+        """
+        return None
+
+
+class SourceReaderWrapper(AbstractSourceReader):
+    """
+    A reader that reads through another reader, such as a caching or
+    instrumented one, and takes its URI, query, output type and pushdown from
+    the reader it wraps.
+    """
+
+    def __init__(self, reader: AbstractSourceReader):
+        self.reader = reader
+
+    @property
+    def uri(self):
+        return self.reader.uri
+
+    @property
+    def query(self):
+        return self.reader.query
+
+    @property
+    def output_type(self):
+        return self.reader.output_type
+
+    @property
+    def supports_pushdown(self):
+        return self.reader.supports_pushdown
+
+    @property
+    def pushdown(self):
+        return self.reader.pushdown
+
+    def push_down(self, columns: Iterable[str]=None, predicates: Iterable[Predicate]=()) -> bool:
+        return self.reader.push_down(columns, predicates)
+
+    def typed_record_mapper(self) -> Optional[Callable[[Dict], SourceOutput]]:
+        return self.reader.typed_record_mapper()
+
 
 class CSVFileReader(AbstractSourceReader):
     query = 'read'
+    supports_pushdown = True
+
+    # Size of the buffer used when reading the file in batches.
+    buffer_size = 1 << 20
+    # Approximate size of the byte ranges parsed by each process when reading
+    # the file in parallel.
+    range_size = 1 << 26
 
-    def __init__(self, filename, field_mapper: Optional[Callable[[Dict], SourceOutput]]=None):
+    def __init__(self, filename, field_mapper: Optional[Callable[[Dict], SourceOutput]]=None,
+                 output_type=None):
         """
         Read a CSV file.
 
         :param filename: the relative path to the file being read.
         :param field_mapper: the function that maps fields for each input line
-            to the output.
+            to the output.  If it is not given, lines are read as records of
+            the record class of `output_type` (see lib.records), as dicts of
+            values of its types if its field names allow no record class, or,
+            if it is not given either, as dicts of strings.
+        :param output_type: the declared Struct type (or List or Stream of
+            Structs) of the output.  This is required to read typed batches.
         """
         self.filename = filename
         self.field_mapping = field_mapper
+        self.output_type = output_type
 
     @property
     def uri(self):
@@ -203,16 +343,382 @@ class CSVFileReader(AbstractSourceReader):
         """
         Return a line iterator for the filename.  This lazily opens the file
         when required and keep the file open until all lines have been
-        consumed.
+        consumed.  Files compressed with gzip, bzip2 or xz are decompressed
+        while being read.
 
         :param filename: the relative path to the file being read.
         """
-        with open(filename) as f:
+        with open_text(filename) as f:
             for line in f:
                 yield line
 
+    def _pushed_down_records(self):
+        with open_text(self.filename, self.buffer_size, newline='') as f:
+            csv_reader = csv.reader(f)
+            header = next(csv_reader, None)
+            if header is None:
+                return
+
+            yield from _pushed_down_records(header, csv_reader, self.pushdown, self.output_type)
+
+    def _record_struct(self):
+        """The Struct type of the records read without a field mapper, given the pushdown."""
+        if self.pushdown is None:
+            return record_struct(self.output_type)
+        return self.pushdown.read_struct(self.output_type, include_predicate_fields=False)
+
+    def _typed_records(self):
+        with open_text(self.filename, self.buffer_size, newline='') as f:
+            csv_reader = csv.reader(f)
+            header = next(csv_reader, None)
+            if header is None:
+                return
+
+            if self.pushdown is None:
+                yield from map(row_parser(self.output_type, header), csv_reader)
+            else:
+                yield from map(record_mapper(self._record_struct()),
+                               _pushed_down_records(header, csv_reader, self.pushdown,
+                                                    self.output_type))
+
+    def typed_record_mapper(self) -> Optional[Callable[[Dict], SourceOutput]]:
+        if self.field_mapping is not None or self.output_type is None:
+            return None
+        if has_record_class(self._record_struct()):
+            return record_class(self._record_struct()).from_values
+        return dict
+
     def read(self, query: str='read'):
-        csv_reader = csv.DictReader(self._file_iterator(self.filename))
+        if self.field_mapping is None and self.output_type is not None:
+            return self._typed_records()
+
+        if self.pushdown is None:
+            records = csv.DictReader(self._file_iterator(self.filename))
+        else:
+            records = self._pushed_down_records()
+
         if self.field_mapping is None:
-            return csv_reader
-        return map(self.field_mapping, csv_reader)
+            return records
+        return map(self.field_mapping, records)
+
+    def read_batches(self, query: str='read', struct_type=None,
+                     batch_size: int=DEFAULT_BATCH_SIZE):
+        """
+        Read the file as typed record batches.  Rows are read in chunks and each
+        field of the Struct type is converted a whole column of a chunk at a
+        time.  The field mapper is not used.
+        """
+        struct_type = self._batch_struct(struct_type)
+        if self.pushdown is None:
+            struct_type = record_struct(struct_type)
+        else:
+            struct_type = self.pushdown.read_struct(struct_type)
+
+        with open_text(self.filename, self.buffer_size, newline='') as f:
+            csv_reader = csv.reader(f)
+            header = next(csv_reader, None)
+            if header is None:
+                return
+
+            result = batches_from_rows(struct_type, header, csv_reader, batch_size)
+            if self.pushdown is not None:
+                result = self.pushdown.apply_to_batches(result)
+            yield from result
+
+    def read_parallel(self, query: str='read', processes: int=None, ordered: bool=True,
+                      as_batches: bool=False, batch_size: int=DEFAULT_BATCH_SIZE):
+        """
+        Read the file on several processes.  The file is memory-mapped and
+        split into byte ranges that start and end on record boundaries (taking
+        quoted newlines into account), and each range is parsed by a process
+        of a process pool.  About twice as many ranges as there are processes
+        are parsed ahead of the output, so memory use does not grow with the
+        size of the file when the output is consumed slowly.
+
+        :param processes: the number of processes. Defaults to the number of CPUs.
+        :param ordered: whether the output is in file order. Unordered output
+            is produced as soon as any range has been parsed.
+        :param as_batches: whether to produce record batches of the
+            `output_type` instead of records. The field mapper, or the record
+            class of the `output_type`, is applied to records in this process.
+
+        Compressed files cannot be split, so they are read on this process.
+        """
+        if as_batches and self.output_type is None:
+            raise RuntimeError('A Struct type is required to read batches from {}.'.format(self))
+        if detect_compression(self.filename) is not None:
+            yield from (self.read_batches(query, batch_size=batch_size) if as_batches
+                        else self.read(query))
+            return
+
+        processes = processes if processes is not None else os.cpu_count()
+        field_mapping = self.field_mapping
+        if field_mapping is None and self.output_type is not None and not as_batches:
+            field_mapping = record_mapper(self._record_struct())
+
+        with open(self.filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                header_end = _next_record_boundary(mm, 0, False)
+                header = next(csv.reader(StringIO(mm[:header_end].decode(), newline='')), [])
+                num_ranges = max(4 * processes, (len(mm) - header_end) // self.range_size)
+                boundaries = _record_boundaries(mm, header_end, num_ranges)
+
+        ranges = zip(boundaries, boundaries[1:])
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            def submit(num_ranges_):
+                return [executor.submit(_read_csv_range, self.filename, start, end, header,
+                                        self.output_type, as_batches, self.pushdown, batch_size)
+                        for start, end in islice(ranges, num_ranges_)]
+
+            def results():
+                if ordered:
+                    in_flight = deque(submit(2 * processes))
+                    while in_flight:
+                        future = in_flight.popleft()
+                        in_flight.extend(submit(1))
+                        yield future.result()
+                else:
+                    in_flight = set(submit(2 * processes))
+                    while in_flight:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            in_flight.update(submit(1))
+                            yield future.result()
+
+            try:
+                for result in results():
+                    if as_batches or field_mapping is None:
+                        yield from result
+                    else:
+                        yield from map(field_mapping, result)
+            finally:
+                executor.shutdown(cancel_futures=True)
+
+
+class JSONLinesFileReader(AbstractSourceReader):
+    query = 'read'
+    supports_pushdown = True
+
+    def __init__(self, filename, field_mapper: Optional[Callable[[Dict], SourceOutput]]=None,
+                 output_type=None):
+        """
+        Read a JSON Lines file, with one JSON object per line.
+
+        :param filename: the relative path to the file being read.
+        :param field_mapper: the function that maps each object to the output.
+        :param output_type: the declared Struct type (or List or Stream of
+            Structs) of the output.  This is required to read typed batches.
+        """
+        self.filename = filename
+        self.field_mapping = field_mapper
+        self.output_type = output_type
+
+    @property
+    def uri(self):
+        return 'file://{}'.format(self.filename)
+
+    @staticmethod
+    def _object_iterator(filename: str):
+        """
+        Return an iterator over the objects in the file.  This lazily opens the
+        file when required and keeps the file open until all objects have been
+        consumed.  Blank lines are skipped.
+        """
+        with open_text(filename, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def read(self, query: str='read'):
+        objects = self._object_iterator(self.filename)
+        if self.pushdown is not None:
+            objects = self.pushdown.apply(objects)
+
+        if self.field_mapping is None:
+            return objects
+        return map(self.field_mapping, objects)
+
+    def read_batches(self, query: str='read', struct_type=None,
+                     batch_size: int=DEFAULT_BATCH_SIZE):
+        """Read the file as typed record batches.  The field mapper is not used."""
+        struct_type = self._batch_struct(struct_type)
+
+        if self.pushdown is None:
+            return batches(struct_type, self._object_iterator(self.filename), batch_size)
+
+        return self.pushdown.apply_to_batches(batches(self.pushdown.read_struct(struct_type),
+                                                      self._object_iterator(self.filename),
+                                                      batch_size))
+
+
+class SQLiteReader(AbstractSourceReader):
+    # Number of rows fetched from the database at a time.
+    fetch_size = 1024
+    supports_pushdown = True
+
+    def __init__(self, database: str, query: str,
+                 field_mapper: Optional[Callable[[Dict], SourceOutput]]=None, output_type=None):
+        """
+        Read the result of a query on a SQLite database.  The database is opened
+        read-only and rows are fetched lazily, `fetch_size` at a time.
+
+        :param database: the relative path to the database file.
+        :param query: the SQL query to run.
+        :param field_mapper: the function that maps each row, as a dict of
+            column names to values, to the output.
+        :param output_type: the declared Struct type (or List or Stream of
+            Structs) of the output.  This is required to read typed batches.
+        """
+        self.database = database
+        self._query = query
+        self.field_mapping = field_mapper
+        self.output_type = output_type
+
+    @property
+    def uri(self):
+        return 'sqlite://{}'.format(self.database)
+
+    @property
+    def query(self):
+        return self._query
+
+    def _row_chunks(self, query: str):
+        """
+        Run the query and yield the column names of the result with each chunk
+        of rows.  Any pushdown is translated into the query, so that the
+        database does the projection and filtering.  The connection is closed
+        once all rows have been consumed.
+        """
+        params = []
+        if self.pushdown is not None:
+            query, params = self.pushdown.to_sql(query)
+
+        connection = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(self.database)), uri=True)
+        try:
+            cursor = connection.execute(query, params)
+            names = [column[0] for column in cursor.description]
+            while True:
+                rows = cursor.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                yield names, rows
+        finally:
+            connection.close()
+
+    def _records(self, query: str):
+        for names, rows in self._row_chunks(query):
+            for row in rows:
+                yield dict(zip(names, row))
+
+    def read(self, query: str=None):
+        records = self._records(query if query is not None else self.query)
+        if self.field_mapping is None:
+            return records
+        return map(self.field_mapping, records)
+
+    def read_batches(self, query: str=None, struct_type=None,
+                     batch_size: int=DEFAULT_BATCH_SIZE):
+        """
+        Read the result of the query as typed record batches, built directly
+        from the fetched rows.  The field mapper is not used.
+        """
+        struct_type = self._batch_struct(struct_type)
+
+        if self.pushdown is not None:
+            struct_type = self.pushdown.read_struct(struct_type, include_predicate_fields=False)
+
+        chunks = self._row_chunks(query if query is not None else self.query)
+        first = next(chunks, None)
+        if first is None:
+            return
+
+        names, rows = first
+        rows = chain(rows, chain.from_iterable(rows for _, rows in chunks))
+        yield from batches_from_rows(struct_type, names, rows, batch_size, column_from_values)
+
+
+def _next_record_boundary(mm: mmap.mmap, position: int, in_quotes: bool) -> int:
+    """
+    Return the offset just after the first newline at or after `position`
+    that is not inside a quoted field, given whether `position` is inside one.
+    """
+    size = len(mm)
+    while position < size:
+        newline = mm.find(b'\n', position)
+        if newline == -1:
+            return size
+        if mm[position:newline].count(b'"') % 2:
+            in_quotes = not in_quotes
+        position = newline + 1
+        if not in_quotes:
+            return position
+    return size
+
+
+def _record_boundaries(mm: mmap.mmap, start: int, num_ranges: int) -> List[int]:
+    """
+    Split the records from `start` to the end of the file into about
+    `num_ranges` ranges and return the boundaries between them.  Quote parity
+    is tracked from one boundary to the next, so newlines inside quoted fields
+    are never used as boundaries.
+    """
+    size = len(mm)
+    step = max((size - start) // max(num_ranges, 1), 1)
+    boundaries = [start]
+    while True:
+        candidate = boundaries[-1] + step
+        if candidate >= size:
+            break
+
+        in_quotes = mm[boundaries[-1]:candidate].count(b'"') % 2 == 1
+        boundary = _next_record_boundary(mm, candidate, in_quotes)
+        if boundary >= size:
+            break
+        boundaries.append(boundary)
+
+    boundaries.append(size)
+    return boundaries
+
+
+def _pushed_down_records(header: Sequence[str], rows: Iterable[Sequence[str]], pushdown: Pushdown,
+                         output_type) -> Iterator[Dict]:
+    """
+    Build dicts of only the fields that must be read from rows of strings and
+    filter them.  Fields used by predicates are converted to their declared
+    types before being compared, if the output type is known.
+    """
+    fields = pushdown.fields_to_read
+    positions = [(name, position) for position, name in enumerate(header)
+                 if fields is None or name in fields]
+
+    definition = record_struct(output_type).definition if output_type is not None else {}
+    predicates = [(predicate, value_parser(definition[predicate.field])
+                   if predicate.field in definition else str)
+                  for predicate in pushdown.predicates]
+
+    for row in rows:
+        record = {name: row[position] for name, position in positions}
+        if all(predicate.matches_value(parse(record[predicate.field]))
+               for predicate, parse in predicates):
+            yield pushdown.project(record)
+
+
+def _read_csv_range(filename: str, start: int, end: int, header: Sequence[str], output_type,
+                    as_batches: bool, pushdown: Optional[Pushdown], batch_size: int) -> List:
+    """Parse the records in a byte range of a CSV file into dicts or record batches."""
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            text = mm[start:end].decode()
+
+    rows = csv.reader(StringIO(text, newline=''))
+    if not as_batches:
+        if pushdown is not None:
+            return list(_pushed_down_records(header, rows, pushdown, output_type))
+        return [dict(zip(header, row)) for row in rows]
+
+    if pushdown is None:
+        return list(batches_from_rows(output_type, header, rows, batch_size))
+    return list(pushdown.apply_to_batches(
+        batches_from_rows(pushdown.read_struct(output_type), header, rows, batch_size)))
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+
+"""
+Distributed execution of pipelines.
+
+A `Coordinator` runs the steps of a pipeline on worker processes, which may be
+on other hosts.  Workers connect to the coordinator over TCP with
+`multiprocessing.connection`, which sends pickled messages and authenticates
+both ends with a shared key:
+
+- a worker introduces itself with `('hello', host, pid)`,
+- the coordinator sends it a step with `('run', version_hash, payload)`, where
+  the payload is the pickled component class, `__init__` arguments, method
+  name, arguments and output names of the step, or stops it with `('stop',)`,
+- the worker replies with `('done', version_hash, size)` once the outputs of
+  the step are written to the result store, or `('failed', version_hash,
+  error)`.
+
+Steps are identified by their version hash, and their outputs are exchanged
+through a `ResultStore` whose directory all workers share, on a network file
+system if they are on several hosts.  Arguments that are outputs of earlier
+steps are sent as `StoredOutput` references, which a worker resolves from the
+outputs it recently produced or loaded, and from the store otherwise.  The
+coordinator keeps track of which outputs each worker holds and assigns a
+step to the idle worker that holds most of its inputs.  Steps that fail, or
+whose worker disconnects or does not reply within `task_timeout` seconds,
+are retried on other workers when possible, up to `max_retries` times.
+
+Each connection is authenticated, and its worker introduced, on a thread of
+its own, so clients that connect and stay silent do not hold up other
+workers; they are dropped after `HELLO_TIMEOUT` seconds.
+
+Workers are started with `run_worker`, with `Coordinator.start_local_workers`
+for worker processes on the local host, or with
+`python -m lib.distributed HOST:PORT STORE_DIRECTORY`, which reads the key
+from the `MEZURI_AUTHKEY` environment variable.
+"""
+
+from argparse import ArgumentParser
+from collections import OrderedDict, namedtuple
+import multiprocessing
+from multiprocessing.connection import (
+    Client, Connection, answer_challenge, deliver_challenge, wait
+)
+import os
+import pickle
+from queue import Empty, Queue
+import socket
+from threading import Thread, Timer
+from time import perf_counter
+from typing import Dict, List, Tuple, Union
+
+from lib import PipelineError
+from lib._pipelinecontext import StepOutputReference
+from lib.execution import (
+    PipelineRun, StepTiming, _run_step, _step_calls, _stream_names, steps_to_run
+)
+from lib.store import ResultStore, StoredOutputs
+
+# Number of step outputs a worker keeps in memory after producing or loading them.
+DEFAULT_WORKER_CACHE_SIZE = 16
+DEFAULT_MAX_RETRIES = 2
+# Seconds a coordinator waits for a worker to connect when it has none.
+DEFAULT_WORKER_TIMEOUT = 60.0
+# Seconds a worker has to authenticate and introduce itself after connecting
+# before it is dropped.
+HELLO_TIMEOUT = 10.0
+AUTHKEY_ENVIRONMENT_VARIABLE = 'MEZURI_AUTHKEY'
+
+# Seconds between checks for new workers while waiting for replies.
+_POLL_INTERVAL = 0.1
+
+
+class StoredOutput(namedtuple('StoredOutput', ['version_hash', 'name'])):
+    """A reference to an output of a step in the result store, as sent to workers."""
+
+
+def _remember(cache: OrderedDict, version_hash: str, outputs, cache_size: int):
+    """Add outputs to an LRU cache of at most `cache_size` entries."""
+    cache[version_hash] = outputs
+    cache.move_to_end(version_hash)
+    while len(cache) > cache_size:
+        cache.popitem(last=False)
+
+
+def _stored_hashes(arguments: Dict) -> List[str]:
+    return [value.version_hash for value in arguments.values() if isinstance(value, StoredOutput)]
+
+
+def _load_arguments(arguments: Dict, store: ResultStore, cache: OrderedDict,
+                    cache_size: int) -> Dict:
+    loaded = {}
+    for name, value in arguments.items():
+        if isinstance(value, StoredOutput):
+            outputs = cache.get(value.version_hash, None)
+            if outputs is None:
+                outputs = dict(StoredOutputs(store.path(value.version_hash)))
+            _remember(cache, value.version_hash, outputs, cache_size)
+            value = outputs[value.name]
+        loaded[name] = value
+    return loaded
+
+
+def run_worker(address: Union[Tuple[str, int], str], authkey: bytes, store_directory: str,
+               cache_size: int=DEFAULT_WORKER_CACHE_SIZE):
+    """
+    Connect to a coordinator and run the steps it sends until it stops the
+    worker or disconnects.
+
+    :param address: the address the coordinator listens on.
+    :param authkey: the key shared with the coordinator.
+    :param store_directory: the directory of the result store of the
+        coordinator, as seen from this worker.
+    :param cache_size: the number of step outputs kept in memory.  This must
+        be the `worker_cache_size` of the coordinator for it to know which
+        outputs the worker holds.
+    """
+    store = ResultStore(store_directory)
+    cache = OrderedDict()
+    with Client(address, authkey=authkey) as connection:
+        connection.send(('hello', socket.gethostname(), os.getpid()))
+        while True:
+            try:
+                message = connection.recv()
+            except EOFError:
+                return
+            if message[0] == 'stop':
+                return
+
+            _, version_hash, payload = message
+            try:
+                (component_class, init_arguments, method_name, arguments, output_names,
+                 stream_names) = pickle.loads(payload)
+                init_arguments = _load_arguments(init_arguments, store, cache, cache_size)
+                arguments = _load_arguments(arguments, store, cache, cache_size)
+                outputs, _, _ = _run_step(component_class, init_arguments, method_name, arguments,
+                                          output_names, stream_names)
+                size = store.write(version_hash, outputs)
+            except (Exception, PipelineError) as e:
+                connection.send(('failed', version_hash, repr(e)))
+                continue
+
+            _remember(cache, version_hash, outputs, cache_size)
+            connection.send(('done', version_hash, size))
+
+
+class _Worker(object):
+    __slots__ = ('connection', 'host', 'pid', 'held', 'task')
+
+    def __init__(self, connection: Connection, host: str, pid: int):
+        self.connection = connection
+        self.host = host
+        self.pid = pid
+        # The version hashes of the outputs the worker holds in memory, in LRU order.
+        self.held = OrderedDict()
+        # The version hash of the step the worker is running, if any.
+        self.task = None
+
+    def __repr__(self):
+        return '{}({}:{})'.format(self.__class__.__name__, self.host, self.pid)
+
+
+class _Task(object):
+    """A step to run, or several identical steps, which have the same version hash."""
+    __slots__ = ('version_hash', 'steps', 'payload', 'inputs', 'dependencies', 'dependents',
+                 'attempts', 'failed_on', 'start')
+
+    def __init__(self, version_hash: str, payload: bytes, inputs: List[str]):
+        self.version_hash = version_hash
+        self.steps = []
+        self.payload = payload
+        # The version hashes of the stored outputs the step uses, in the order it loads them.
+        self.inputs = inputs
+        self.dependencies = set()
+        self.dependents = []
+        self.attempts = 0
+        self.failed_on = set()
+        self.start = None
+
+
+class Coordinator(object):
+    """Runs the steps of pipelines on workers that connect to it."""
+
+    def __init__(self, resolver, store: ResultStore,
+                 address: Union[Tuple[str, int], str]=('localhost', 0), authkey: bytes=None,
+                 max_retries: int=DEFAULT_MAX_RETRIES,
+                 worker_cache_size: int=DEFAULT_WORKER_CACHE_SIZE,
+                 worker_timeout: float=DEFAULT_WORKER_TIMEOUT, task_timeout: float=None):
+        """
+        :param resolver: the function, or dict, that maps the component proxy
+            of a step to the class that implements it.  Classes must be
+            importable by workers under the same name.
+        :param store: the store that workers write outputs to and read inputs
+            from.  Its budget, if any, must hold the outputs of a run.
+        :param address: the address to listen on; by default, a free port of
+            the local host.  Listen on a public interface for workers on other
+            hosts.
+        :param authkey: the key workers authenticate with; by default, a
+            random one.
+        :param max_retries: the number of times a failed step is retried.
+        :param worker_cache_size: the number of step outputs workers keep in
+            memory.
+        :param worker_timeout: the number of seconds to wait for a worker to
+            connect when there are none.
+        :param task_timeout: the number of seconds a worker has to run a
+            step, if any.  A worker that takes longer is dropped, and the step
+            is retried on another worker.
+        """
+        if not callable(resolver):
+            resolver = resolver.__getitem__
+
+        self._resolve = resolver
+        self.store = store
+        self.authkey = authkey if authkey is not None else os.urandom(32)
+        self.max_retries = max_retries
+        self.worker_cache_size = worker_cache_size
+        self.worker_timeout = worker_timeout
+        self.task_timeout = task_timeout
+        self._workers = []
+        self._local_processes = []
+
+        self._closed = False
+        self._socket = _listen(address)
+        self.address = self._socket.getsockname()
+        # The workers that authenticated and introduced themselves, not added yet.
+        self._connections = Queue()
+        self._accept_thread = Thread(target=self._accept, daemon=True)
+        self._accept_thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._socket.accept()
+            except OSError:
+                if self._closed:
+                    return
+                continue
+            Thread(target=self._handshake, args=(sock,), daemon=True).start()
+
+    def _handshake(self, sock: socket.socket):
+        """
+        Authenticate a connection and receive the introduction of its worker,
+        or drop it if this takes more than `HELLO_TIMEOUT` seconds.
+        """
+        # Shutting the socket down wakes up reads of the connection, which
+        # uses a duplicate of its file descriptor.
+        timer = Timer(HELLO_TIMEOUT, _shutdown, args=(sock,))
+        timer.start()
+        connection = Connection(os.dup(sock.fileno()))
+        try:
+            deliver_challenge(connection, self.authkey)
+            answer_challenge(connection, self.authkey)
+            message = connection.recv()
+        except (EOFError, OSError, multiprocessing.AuthenticationError):
+            connection.close()
+            return
+        finally:
+            timer.cancel()
+            sock.close()
+
+        if isinstance(message, tuple) and len(message) == 3 and message[0] == 'hello':
+            self._connections.put(_Worker(connection, message[1], message[2]))
+        else:
+            connection.close()
+
+    def start_local_workers(self, count: int) -> List[multiprocessing.Process]:
+        """Start `count` worker processes on the local host, stopped when the coordinator closes."""
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=run_worker,
+                                     args=(self.address, self.authkey, self.store.directory,
+                                           self.worker_cache_size),
+                                     daemon=True)
+                     for _ in range(count)]
+        for process in processes:
+            process.start()
+        self._local_processes.extend(processes)
+        return processes
+
+    @property
+    def workers(self) -> List[Tuple[str, int]]:
+        """The hosts and process ids of the connected workers."""
+        return [(worker.host, worker.pid) for worker in self._workers]
+
+    def _add_workers(self, timeout: float=None):
+        """Add the workers that connected, waiting up to `timeout` seconds for one if given."""
+        while True:
+            try:
+                worker = self._connections.get(timeout=timeout) if timeout else \
+                    self._connections.get_nowait()
+            except Empty:
+                return
+            timeout = None
+            self._workers.append(worker)
+
+    def _remove_worker(self, worker: _Worker):
+        self._workers.remove(worker)
+        worker.connection.close()
+        # A local worker that is dropped while it runs a step would run it to the end.
+        for process in self._local_processes:
+            if process.pid == worker.pid and worker.task is not None:
+                process.terminate()
+
+    def _task(self, step) -> _Task:
+        init_call, method_call = _step_calls(step)
+
+        def stored(arguments: Dict) -> Dict:
+            return {name: StoredOutput(value.step.version_hash(), value.name)
+                    if isinstance(value, StepOutputReference) else value
+                    for name, value in arguments.items()}
+
+        init_arguments = stored(init_call.inputs) if init_call else {}
+        arguments = stored(method_call.inputs)
+        payload = pickle.dumps((self._resolve(step._component), init_arguments, method_call.method,
+                                arguments, tuple(method_call.output_specs),
+                                _stream_names(method_call)),
+                               protocol=pickle.HIGHEST_PROTOCOL)
+        return _Task(step.version_hash(), payload,
+                     _stored_hashes(init_arguments) + _stored_hashes(arguments))
+
+    def _hold(self, worker: _Worker, task: _Task):
+        """Record the outputs a worker holds after running a task, as it caches them."""
+        for version_hash in task.inputs + [task.version_hash]:
+            _remember(worker.held, version_hash, True, self.worker_cache_size)
+
+    def _assign(self, ready: List[_Task], idle: List[_Worker]) -> Tuple[_Task, _Worker]:
+        """Pick the task and idle worker that maximize the inputs the worker already holds."""
+        def score(pair):
+            task, worker = pair
+            return (id(worker) not in task.failed_on,
+                    sum(1 for version_hash in task.inputs if version_hash in worker.held))
+        return max(((task, worker) for task in ready for worker in idle), key=score)
+
+    def run(self, pipeline) -> PipelineRun:
+        """Run the steps of a pipeline on the workers and return their outputs and timings."""
+        start = perf_counter()
+        outputs = {}
+        steps, cached_steps = steps_to_run(pipeline, self.store, outputs)
+        # The entries of the store that the run uses, which are pinned until it is complete.
+        pinned = [step.version_hash() for step in cached_steps]
+        try:
+            timings = self._run_tasks(steps, start, outputs, pinned)
+        finally:
+            self.store.unpin(pinned)
+        return PipelineRun(pipeline, outputs, timings, perf_counter() - start, cached_steps)
+
+    def _run_tasks(self, steps: List, start: float, outputs: Dict[int, Dict],
+                   pinned: List[str]) -> List[StepTiming]:
+        tasks = {}
+        for step in steps:
+            version_hash = step.version_hash()
+            if version_hash not in tasks:
+                tasks[version_hash] = self._task(step)
+            tasks[version_hash].steps.append(step)
+        for task in tasks.values():
+            for step in task.steps:
+                for prev_step in step._dependencies():
+                    dependency = tasks.get(prev_step.version_hash(), None)
+                    if dependency is not None and dependency.version_hash not in task.dependencies:
+                        task.dependencies.add(dependency.version_hash)
+                        dependency.dependents.append(task)
+
+        timings = []
+        remaining = len(tasks)
+        ready = [task for task in tasks.values() if not task.dependencies]
+
+        def retry(task: _Task, worker: _Worker, error: str):
+            task.attempts += 1
+            task.failed_on.add(id(worker))
+            if task.attempts > self.max_retries:
+                raise PipelineError('step {} failed {} times, last on {}: {}'.format(
+                    _step_calls(task.steps[0])[1].method, task.attempts, worker, error))
+            ready.append(task)
+
+        while remaining:
+            self._add_workers()
+            if not self._workers:
+                self._add_workers(timeout=self.worker_timeout)
+                if not self._workers:
+                    raise PipelineError('no worker connected in {}s'.format(self.worker_timeout))
+
+            idle = [worker for worker in self._workers if worker.task is None]
+            while ready and idle:
+                task, worker = self._assign(ready, idle)
+                ready.remove(task)
+                idle.remove(worker)
+                try:
+                    worker.connection.send(('run', task.version_hash, task.payload))
+                except OSError:
+                    self._remove_worker(worker)
+                    ready.append(task)
+                    continue
+                worker.task = task.version_hash
+                task.start = perf_counter()
+
+            busy = {worker.connection: worker for worker in self._workers
+                    if worker.task is not None}
+            for connection in wait(list(busy), timeout=_POLL_INTERVAL):
+                worker = busy[connection]
+                version_hash = worker.task
+                # Replies to steps of earlier runs that were interrupted are
+                # still stored, but are otherwise ignored.
+                task = tasks.get(version_hash, None)
+                try:
+                    message = connection.recv()
+                except (EOFError, OSError):
+                    self._remove_worker(worker)
+                    if task is not None:
+                        retry(task, worker, 'worker disconnected')
+                    continue
+
+                worker.task = None
+                if message[0] == 'failed':
+                    if task is not None:
+                        retry(task, worker, message[2])
+                    continue
+
+                self.store.add(version_hash, message[2], pin=True)
+                pinned.append(version_hash)
+                if task is None:
+                    continue
+                end = perf_counter()
+                self._hold(worker, task)
+                remaining -= 1
+                for step in task.steps:
+                    outputs[id(step)] = StoredOutputs(self.store.path(version_hash))
+                    timings.append(StepTiming(step, task.start - start, end - start))
+                for dependent in task.dependents:
+                    dependent.dependencies.discard(version_hash)
+                    if not dependent.dependencies:
+                        ready.append(dependent)
+
+            if self.task_timeout is not None:
+                now = perf_counter()
+                for worker in busy.values():
+                    task = tasks.get(worker.task, None)
+                    if (task is not None and worker in self._workers and
+                            now - task.start > self.task_timeout):
+                        self._remove_worker(worker)
+                        retry(task, worker, 'no reply in {}s'.format(self.task_timeout))
+        return timings
+
+    def close(self):
+        """Stop the workers and the local worker processes, and stop listening."""
+        for worker in list(self._workers):
+            try:
+                worker.connection.send(('stop',))
+            except OSError:
+                pass
+            self._remove_worker(worker)
+        self._closed = True
+        _shutdown(self._socket)
+        self._socket.close()
+        while True:
+            try:
+                self._connections.get_nowait().connection.close()
+            except Empty:
+                break
+        for process in self._local_processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._local_processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _listen(address: Union[Tuple[str, int], str]) -> socket.socket:
+    """Return a socket listening on a TCP address, or on a Unix socket path."""
+    sock = socket.socket(socket.AF_UNIX if isinstance(address, str) else socket.AF_INET)
+    if not isinstance(address, str):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen()
+    return sock
+
+
+def _shutdown(sock: socket.socket):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def _parse_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+
+def main():
+    parser = ArgumentParser(prog='lib.distributed',
+                            description='Run a pipeline worker for a coordinator. The key shared '
+                                        'with the coordinator is read from the {} environment '
+                                        'variable, in hex.'.format(AUTHKEY_ENVIRONMENT_VARIABLE))
+    parser.add_argument('address', help='The HOST:PORT the coordinator listens on.')
+    parser.add_argument('store', help='The directory of the result store of the coordinator.')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_WORKER_CACHE_SIZE,
+                        help='The number of step outputs to keep in memory.')
+    args = parser.parse_args()
+
+    authkey = os.environ.get(AUTHKEY_ENVIRONMENT_VARIABLE, None)
+    if authkey is None:
+        print('{} is not set.'.format(AUTHKEY_ENVIRONMENT_VARIABLE))
+        return 1
+    run_worker(_parse_address(args.address), bytes.fromhex(authkey), args.store, args.cache_size)
+
+
+if __name__ == '__main__':
+    main()
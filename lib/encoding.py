@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+"""
+Compact binary encoding for Mezuri serializable objects.
+
+This is an alternative to the JSON form of `Serialized` trees that is used in
+specification files.  An encoded object has the following layout:
+
+    magic        b'MZT' followed by the format version (1 byte)
+    fingerprint  the 20 byte structural fingerprint of the encoded object
+    strings      varint count, then each string as varint length + UTF-8 bytes
+    body         the tagged `Serialized` tree, referring to strings by index
+
+All data types, field names and other strings are stored once in the string
+table, and repeated subtrees (e.g. the same type used by many fields of a wide
+Struct) are stored once and referred to by index afterwards.  Decoding builds
+each distinct subtree once.
+"""
+
+from typing import List as ListType, Tuple
+
+import lib.types as mezuri_types
+
+MAGIC = b'MZT\x01'
+FINGERPRINT_SIZE = 20
+
+_TAG_NONE = 0
+_TAG_SERIALIZED = 1
+_TAG_MAP = 2
+_TAG_SEQUENCE = 3
+_TAG_STRING = 4
+_TAG_REFERENCE = 5
+
+
+class EncodingError(ValueError):
+    pass
+
+
+def _write_varint(buffer: bytearray, value: int):
+    while value >= 0x80:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varint(data: bytes, offset: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        try:
+            byte = data[offset]
+        except IndexError:
+            raise EncodingError('truncated data')
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+
+class _Encoder(object):
+    def __init__(self):
+        self.strings = []
+        self.string_indices = {}
+        self.node_indices = {}
+        self.body = bytearray()
+
+    def _string_index(self, string: str) -> int:
+        index = self.string_indices.get(string, None)
+        if index is None:
+            index = self.string_indices[string] = len(self.strings)
+            self.strings.append(string)
+        return index
+
+    def write(self, value):
+        """
+        Write a value to the body and return a hashable key for its structure.
+        `Serialized` nodes are keyed by their index, which is assigned after
+        their contents are written.
+        """
+        body = self.body
+        if value is None:
+            body.append(_TAG_NONE)
+            return None
+        if isinstance(value, mezuri_types.Serialized):
+            start = len(body)
+            body.append(_TAG_SERIALIZED)
+            _write_varint(body, self._string_index(value.data_type))
+            key = (value.data_type, self.write(value.contents))
+
+            index = self.node_indices.get(key, None)
+            if index is None:
+                index = self.node_indices[key] = len(self.node_indices)
+            else:
+                del body[start:]
+                body.append(_TAG_REFERENCE)
+                _write_varint(body, index)
+            return index
+        if isinstance(value, dict):
+            body.append(_TAG_MAP)
+            _write_varint(body, len(value))
+            keys = []
+            for k, v in value.items():
+                _write_varint(body, self._string_index(k))
+                keys.append((k, self.write(v)))
+            return 'map', tuple(keys)
+        if isinstance(value, (tuple, list)):
+            body.append(_TAG_SEQUENCE)
+            _write_varint(body, len(value))
+            return 'sequence', tuple(self.write(v) for v in value)
+        if isinstance(value, str):
+            body.append(_TAG_STRING)
+            _write_varint(body, self._string_index(value))
+            return 'string', value
+        raise EncodingError('cannot encode value of type {}'.format(type(value).__name__))
+
+
+class _Decoder(object):
+    def __init__(self, data: bytes, strings: ListType[str], offset: int):
+        self.data = data
+        self.strings = strings
+        self.offset = offset
+        self.nodes = []
+
+    def _varint(self) -> int:
+        value, self.offset = _read_varint(self.data, self.offset)
+        return value
+
+    def _string(self) -> str:
+        index = self._varint()
+        try:
+            return self.strings[index]
+        except IndexError:
+            raise EncodingError('invalid string reference {}'.format(index))
+
+    def read(self):
+        try:
+            tag = self.data[self.offset]
+        except IndexError:
+            raise EncodingError('truncated data')
+        self.offset += 1
+
+        if tag == _TAG_REFERENCE:
+            index = self._varint()
+            try:
+                return self.nodes[index]
+            except IndexError:
+                raise EncodingError('invalid node reference {}'.format(index))
+        if tag == _TAG_SERIALIZED:
+            data_type = self._string()
+            deserializer = mezuri_types.deserializers.get(data_type, None)
+            if deserializer is None:
+                raise EncodingError('unknown data type {}'.format(data_type))
+            contents = self.read()
+            try:
+                node = deserializer.deserialize(contents)
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                raise EncodingError('invalid contents of {}: {!r}'.format(data_type, e))
+            self.nodes.append(node)
+            return node
+        if tag == _TAG_MAP:
+            result = {}
+            for _ in range(self._varint()):
+                key = self._string()
+                result[key] = self.read()
+            return result
+        if tag == _TAG_SEQUENCE:
+            return tuple(self.read() for _ in range(self._varint()))
+        if tag == _TAG_STRING:
+            return self._string()
+        if tag == _TAG_NONE:
+            return None
+        raise EncodingError('invalid tag {}'.format(tag))
+
+
+def encode(obj: mezuri_types.AbstractMezuriSerializable) -> bytes:
+    """Encode a serializable object into the compact binary form."""
+    encoder = _Encoder()
+    encoder.write(obj.serialize())
+
+    result = bytearray(MAGIC)
+    result += bytes.fromhex(obj.fingerprint)
+    _write_varint(result, len(encoder.strings))
+    for string in encoder.strings:
+        encoded = string.encode()
+        _write_varint(result, len(encoded))
+        result += encoded
+    result += encoder.body
+    return bytes(result)
+
+
+def read_fingerprint(data: bytes) -> str:
+    """Return the fingerprint of an encoded object without decoding it."""
+    if data[:len(MAGIC)] != MAGIC:
+        raise EncodingError('data is not an encoded Mezuri object')
+
+    fingerprint = data[len(MAGIC):len(MAGIC) + FINGERPRINT_SIZE]
+    if len(fingerprint) != FINGERPRINT_SIZE:
+        raise EncodingError('truncated data')
+    return fingerprint.hex()
+
+
+def decode(data: bytes) -> mezuri_types.AbstractMezuriSerializable:
+    """Decode an object encoded by `encode`, checking it against its fingerprint."""
+    fingerprint = read_fingerprint(data)
+
+    offset = len(MAGIC) + FINGERPRINT_SIZE
+    num_strings, offset = _read_varint(data, offset)
+    strings = []
+    for _ in range(num_strings):
+        length, offset = _read_varint(data, offset)
+        if offset + length > len(data):
+            raise EncodingError('truncated data')
+        try:
+            strings.append(bytes(data[offset:offset + length]).decode())
+        except UnicodeDecodeError:
+            raise EncodingError('invalid string at offset {}'.format(offset))
+        offset += length
+
+    decoder = _Decoder(data, strings, offset)
+    obj = decoder.read()
+    if decoder.offset != len(data):
+        raise EncodingError('unexpected trailing data')
+
+    if not isinstance(obj, mezuri_types.AbstractMezuriSerializable):
+        raise EncodingError('data does not encode a Mezuri object')
+    if obj.fingerprint != fingerprint:
+        raise EncodingError('decoded object does not match its fingerprint')
+    return obj
@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+
+"""
+Execution of pipelines.
+
+A `PipelineExecutor` runs the steps of a pipeline on a thread or process pool.
+Each step is submitted as soon as all the steps whose outputs it uses are
+done, so independent steps run concurrently.  The component of a step is
+resolved to its implementation class, instantiated with the arguments of its
+`__init__` call, and its method is called with the outputs of earlier steps in
+place of the references to them.
+
+A component method returns the value of its output if it declares a single
+one, or a dict of the values of its outputs.  Source methods return readers,
+whose output is read in full, unless the step is streamed.  The fields that
+the later steps declare for the arguments they pass the output of a source
+step to are pushed down into its reader (see `lib.pushdown`), so that it only
+produces those, unless the step is a last step or a result store is used.
+
+With a `ResultStore`, the outputs of every step that is run are stored under
+its version hash, and steps whose outputs are already stored are not run,
+nor are the steps that only they depend on.  Stored outputs are only loaded
+if a step that is run, or the caller, uses them, and are pinned in the store
+while the run is in progress.
+
+In streaming mode, on threads, a step whose only output is a `Stream` used by
+a single later step is connected to that step through a bounded channel
+instead of having its output collected in full: it runs on a thread of its
+own and blocks while the channel is full, and the later step starts as soon
+as the channel is created and iterates over it.  A chain of such steps runs
+in constant memory however large its input is.  Streamed outputs are not
+stored in a result store, and are exhausted once the run is complete.
+"""
+
+from collections import namedtuple
+from itertools import chain, islice
+from concurrent.futures import (
+    Executor, FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+)
+from time import perf_counter
+from typing import (
+    Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+)
+
+from lib import PipelineError
+from lib._pipelinecontext import StepOutputReference
+from lib.definitions import AbstractSourceReader
+from lib.prefetch import Prefetcher
+from lib.pushdown import consumed_fields
+from lib.profiling import RunProfile, StepProfiler, run_profiled
+from lib.store import ResultStore
+import lib.types as mezuri_types
+
+_POOL_CLASSES = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+
+# Default number of items a channel between streamed steps holds.
+DEFAULT_CHANNEL_CAPACITY = 4096
+# Number of items passed through a channel at a time.
+CHANNEL_CHUNK_SIZE = 256
+
+
+class StepTiming(namedtuple('StepTiming', ['step', 'start', 'end'])):
+    """The start and end of the run of a step, in seconds since the start of the pipeline run."""
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class PipelineRun(object):
+    """The outputs and timings of a run of a pipeline."""
+
+    def __init__(self, pipeline, outputs: Dict[int, Dict], timings: List[StepTiming],
+                 duration: float, cached_steps: List=(), profile: RunProfile=None):
+        self.pipeline = pipeline
+        self._outputs = outputs
+        self.timings = timings
+        self.duration = duration
+        # The steps whose outputs were taken from a result store instead of being run.
+        self.cached_steps = list(cached_steps)
+        # The profiles of the steps, if the run was profiled.
+        self.profile = profile
+
+    def outputs_of(self, step) -> Dict:
+        """
+        Return the outputs of a step of the pipeline, by name.  Steps that only
+        cached steps depend on have no outputs.
+        """
+        return self._outputs[id(step)]
+
+    @property
+    def output(self) -> Dict:
+        """The outputs of the last step of the pipeline."""
+        return self.outputs_of(self.pipeline.last_step)
+
+    def report(self) -> List[Dict]:
+        """Return the timings of the steps in the order they started, as dicts."""
+        return [{
+            'component': repr(timing.step._component),
+            'method': _step_calls(timing.step)[1].method,
+            'start': timing.start,
+            'duration': timing.duration,
+        } for timing in sorted(self.timings, key=lambda timing: timing.start)]
+
+
+def _step_calls(step) -> Tuple:
+    """Return the `__init__` call (or None) and the method call of a step."""
+    init_call = None
+    method_call = None
+    for call in step._method_calls:
+        if call.method == '__init__':
+            init_call = call
+        else:
+            method_call = call
+    return init_call, method_call
+
+
+def _step_name(step) -> str:
+    return '{!r}.{}'.format(step._component, _step_calls(step)[1].method)
+
+
+def _resolved_arguments(arguments: Dict, outputs: Dict[int, Dict]) -> Dict:
+    return {name: outputs[id(value.step)][value.name]
+            if isinstance(value, StepOutputReference) else value
+            for name, value in arguments.items()}
+
+
+def _call_step(component_class: type, init_arguments: Dict, method_name: str, arguments: Dict,
+               columns: Optional[FrozenSet[str]]=None):
+    component = component_class(**init_arguments)
+    result = getattr(component, method_name)(**arguments)
+    if columns is not None and isinstance(result, AbstractSourceReader):
+        pushdown = result.pushdown
+        if pushdown is not None and pushdown.columns is not None:
+            columns = columns.intersection(pushdown.columns)
+        result.push_down(columns, pushdown.predicates if pushdown is not None else ())
+    return result
+
+
+def _read_lazily(result):
+    """Return the output of a source reader as an iterator, or any other result as is."""
+    if isinstance(result, AbstractSourceReader):
+        return result.read(result.query)
+    return result
+
+
+def _run_step(component_class: type, init_arguments: Dict, method_name: str, arguments: Dict,
+              output_names: Sequence[str], stream_names: Sequence[str]=(),
+              columns: Optional[FrozenSet[str]]=None) -> Tuple[Dict, float, float]:
+    """
+    Run the component of a step and return its outputs by name, with when it
+    started and ended.  The output of a source reader is read in full, after
+    pushing `columns`, if given, down into it, and
+    outputs that are streams are collected in lists, so that outputs can be
+    used by several steps, pickled and stored.
+    """
+    start = perf_counter()
+    result = _call_step(component_class, init_arguments, method_name, arguments, columns)
+    if isinstance(result, AbstractSourceReader):
+        result = list(result.read(result.query))
+
+    if len(output_names) == 1:
+        outputs = {output_names[0]: result}
+    elif isinstance(result, dict) and set(result) == set(output_names):
+        outputs = result
+    else:
+        raise PipelineError('{}.{} must return a dict of its outputs {}'.format(
+            component_class.__name__, method_name, ', '.join(output_names)))
+
+    for name in stream_names:
+        if not isinstance(outputs[name], list):
+            outputs[name] = list(outputs[name])
+    return outputs, start, perf_counter()
+
+
+def _streamed_step_chunks(times: List[float], component_class: type, init_arguments: Dict,
+                          method_name: str, arguments: Dict,
+                          columns: Optional[FrozenSet[str]]=None):
+    times.append(perf_counter())
+    items = iter(_read_lazily(_call_step(component_class, init_arguments, method_name,
+                                         arguments, columns)))
+    yield from iter(lambda: list(islice(items, CHANNEL_CHUNK_SIZE)), [])
+    times.append(perf_counter())
+
+
+class Channel(object):
+    """
+    The output of a streamed step, as iterated over by the step that uses it.
+    Items are produced on a background thread and passed in chunks through a
+    bounded queue, so the producer blocks while the consumer is behind.
+    """
+
+    def __init__(self, produce_chunks: Callable[[], Iterable[list]], capacity: int):
+        self._chunks = Prefetcher(produce_chunks, max(capacity // CHANNEL_CHUNK_SIZE, 1))
+
+    def __iter__(self) -> Iterator:
+        return chain.from_iterable(self._chunks)
+
+    def close(self):
+        self._chunks.close()
+
+
+def _stream_names(method_call) -> Tuple[str, ...]:
+    return tuple(name for name, type_ in method_call.output_specs.items()
+                 if isinstance(type_, mezuri_types.Stream))
+
+
+class _AliasedOutputs(dict):
+    """
+    The outputs of steps by the ids of the steps.  Steps can be aliases of
+    equivalent steps, which are run in their place: the outputs of an alias
+    are those of its step.
+    """
+
+    def __init__(self, aliases: Dict[int, object]=None):
+        super().__init__()
+        self._aliases = aliases or {}
+
+    def canonical(self, step):
+        """Return the step that is run in place of a step."""
+        return self._aliases.get(id(step), step)
+
+    def __missing__(self, step_id: int):
+        step = self._aliases.get(step_id, None)
+        if step is None:
+            raise KeyError(step_id)
+        return self[id(step)]
+
+    def __contains__(self, step_id: int) -> bool:
+        step = self._aliases.get(step_id, None)
+        return super().__contains__(step_id if step is None else id(step))
+
+
+def _steps_to_run(last_steps: List, store: ResultStore,
+                  outputs: _AliasedOutputs) -> Tuple[List, List]:
+    steps = []
+    cached_steps = []
+    visited = set()
+    stack = [outputs.canonical(step) for step in last_steps]
+    while stack:
+        step = stack.pop()
+        if id(step) in visited:
+            continue
+        visited.add(id(step))
+
+        stored_outputs = store.get(step.version_hash(), pin=True) if store is not None else None
+        if stored_outputs is not None:
+            outputs[id(step)] = stored_outputs
+            cached_steps.append(step)
+        else:
+            steps.append(step)
+            stack.extend(outputs.canonical(prev_step) for prev_step in step._dependencies())
+    return steps, cached_steps
+
+
+def steps_to_run(pipeline, store: ResultStore, outputs: Dict[int, Dict]) -> Tuple[List, List]:
+    """
+    Return the steps of a pipeline that must be run and the steps whose
+    outputs are taken from `store`, if any, which are added to `outputs`.
+    Their entries are pinned in the store, and must be unpinned once the run
+    is complete.
+    """
+    if store is None:
+        return pipeline.steps(), []
+
+    aliased_outputs = _AliasedOutputs()
+    steps, cached_steps = _steps_to_run([pipeline.last_step], store, aliased_outputs)
+    outputs.update(aliased_outputs)
+    return steps, cached_steps
+
+
+class PipelineExecutor(object):
+    def __init__(self, resolver: Union[Callable[[object], type], Dict[object, type]],
+                 executor: Union[str, Executor]='thread', max_workers: int=None,
+                 store: ResultStore=None, streaming: bool=False,
+                 channel_capacity: int=DEFAULT_CHANNEL_CAPACITY, profile: bool=False,
+                 trace_memory: bool=True, pushdown: bool=True):
+        """
+        :param resolver: the function, or dict, that maps the component proxy
+            of a step to the class that implements it.
+        :param executor: 'thread' or 'process' to run steps on a new pool of
+            that kind, or an existing `concurrent.futures.Executor`.  Classes,
+            arguments and outputs must be picklable to run steps on processes.
+        :param max_workers: the maximum number of workers of a new pool.
+        :param store: the store to take the outputs of steps from, if they are
+            in it, and to store the outputs of the steps that are run in.
+        :param streaming: whether to stream `Stream` outputs between steps.
+            This requires running steps on threads.
+        :param channel_capacity: the number of items a channel between
+            streamed steps holds.
+        :param profile: whether to profile the steps of runs.  See
+            `lib.profiling`; streamed steps only have their times profiled.
+        :param trace_memory: whether to trace the peak memory of steps when
+            profiling.
+        :param pushdown: whether to push the fields that later steps consume
+            down into the readers of source steps.  The outputs of these steps
+            then only have those fields.
+        """
+        if not callable(resolver):
+            resolver = resolver.__getitem__
+        if isinstance(executor, str) and executor not in _POOL_CLASSES:
+            raise ValueError('unknown executor {}'.format(executor))
+        if streaming and not (executor == 'thread' or isinstance(executor, ThreadPoolExecutor)):
+            raise ValueError('streaming requires running steps on threads')
+
+        self._resolve = resolver
+        self._executor = executor
+        self.max_workers = max_workers
+        self.store = store
+        self.streaming = streaming
+        self.channel_capacity = channel_capacity
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.pushdown = pushdown
+
+    def _arguments(self, step, outputs: Dict[int, Dict]) -> Tuple:
+        init_call, method_call = _step_calls(step)
+        return (self._resolve(step._component),
+                _resolved_arguments(init_call.inputs, outputs) if init_call else {},
+                method_call.method, _resolved_arguments(method_call.inputs, outputs))
+
+    def _consumed_fields(self, step, dependents: List, last_step_ids,
+                         outputs: _AliasedOutputs) -> Optional[FrozenSet[str]]:
+        """Return the fields to push down into the reader of a step, if any."""
+        # Stored outputs must be complete, as other pipelines may use them.
+        if not self.pushdown or self.store is not None or id(step) in last_step_ids:
+            return None
+        return consumed_fields(step, dependents, outputs.canonical)
+
+    def _submit(self, pool: Executor, step, outputs: Dict[int, Dict],
+                columns: Optional[FrozenSet[str]]=None):
+        method_call = _step_calls(step)[1]
+        arguments = self._arguments(step, outputs) + (tuple(method_call.output_specs),
+                                                      _stream_names(method_call), columns)
+        if self.profile:
+            input_names = tuple(name for name, value in method_call.inputs.items()
+                                if isinstance(value, StepOutputReference))
+            return pool.submit(run_profiled, _run_step, arguments, input_names, self.trace_memory)
+        return pool.submit(_run_step, *arguments)
+
+    def _stream(self, step, outputs: Dict[int, Dict],
+                columns: Optional[FrozenSet[str]]=None) -> Tuple[Channel, List[float]]:
+        """Start running a streamed step and return the channel of its output."""
+        times = []
+        arguments = self._arguments(step, outputs) + (columns,)
+        channel = Channel(lambda: _streamed_step_chunks(times, *arguments), self.channel_capacity)
+        return channel, times
+
+    @staticmethod
+    def _is_streamed(step, dependents: List, outputs: _AliasedOutputs) -> bool:
+        """Whether the only output of a step is a Stream that a single step uses."""
+        method_call = _step_calls(step)[1]
+        if len(method_call.output_specs) != 1 or not _stream_names(method_call):
+            return False
+
+        uses = sum(1 for dependent in dependents for call in dependent._method_calls
+                   for value in call.inputs.values()
+                   if isinstance(value, StepOutputReference) and
+                   outputs.canonical(value.step) is step)
+        return uses == 1
+
+    def _run(self, pool: Executor, steps: List, last_steps: List, outputs: _AliasedOutputs,
+             profiler: StepProfiler=None) -> List[StepTiming]:
+        timings = []
+        last_step_ids = {id(outputs.canonical(step)) for step in last_steps}
+        dependents = {id(step): [] for step in steps}
+        num_dependencies = {}
+        for step in steps:
+            prev_step_ids = {id(outputs.canonical(prev_step)) for prev_step in step._dependencies()
+                             if id(prev_step) not in outputs}
+            num_dependencies[id(step)] = len(prev_step_ids)
+            for prev_step_id in prev_step_ids:
+                dependents[prev_step_id].append(step)
+
+        start = perf_counter()
+        running = {}
+        streamed = []
+        ready = [step for step in steps if num_dependencies[id(step)] == 0]
+        if profiler is not None:
+            profiler.start(start)
+            for step in ready:
+                profiler.ready(step)
+
+        def mark_done(step_):
+            for dependent in dependents[id(step_)]:
+                num_dependencies[id(dependent)] -= 1
+                if num_dependencies[id(dependent)] == 0:
+                    ready.append(dependent)
+                    if profiler is not None:
+                        profiler.ready(dependent)
+
+        try:
+            while ready or running:
+                while ready:
+                    step = ready.pop()
+                    columns = self._consumed_fields(step, dependents[id(step)], last_step_ids,
+                                                    outputs)
+                    if self.streaming and id(step) not in last_step_ids and self._is_streamed(
+                            step, dependents[id(step)], outputs):
+                        channel, times = self._stream(step, outputs, columns)
+                        outputs[id(step)] = {next(iter(_step_calls(step)[1].output_specs)):
+                                             channel}
+                        streamed.append((step, channel, times))
+                        mark_done(step)
+                    else:
+                        running[self._submit(pool, step, outputs, columns)] = step
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    try:
+                        result = future.result()
+                    except BaseException as e:
+                        raise PipelineError('step {} failed: {!r}'.format(
+                            _step_calls(step)[1].method, e)) from e
+
+                    measurement = None
+                    if profiler is not None:
+                        result, measurement = result
+                    step_outputs, step_start, step_end = result
+                    outputs[id(step)] = step_outputs
+                    timings.append(StepTiming(step, step_start - start, step_end - start))
+                    if profiler is not None:
+                        profiler.add(step, _step_name(step), step_start - start, step_end - start,
+                                     measurement)
+                    if self.store is not None:
+                        self.store.put(step.version_hash(), step_outputs)
+                    mark_done(step)
+        except BaseException:
+            for pending in running:
+                pending.cancel()
+            raise
+        finally:
+            for _, channel, _ in streamed:
+                channel.close()
+
+        for step, _, times in streamed:
+            if len(times) == 2:
+                timings.append(StepTiming(step, times[0] - start, times[1] - start))
+                if profiler is not None:
+                    profiler.add(step, _step_name(step), times[0] - start, times[1] - start)
+        return timings
+
+    def run(self, pipeline) -> PipelineRun:
+        """Run the steps of a pipeline and return their outputs and timings."""
+        return self.run_all([pipeline])[0]
+
+    def run_all(self, pipelines: Sequence, aliases: Dict[int, object]=None) -> List[PipelineRun]:
+        """
+        Run the steps of several pipelines together, each step once, and
+        return the run of each pipeline.
+
+        :param pipelines: the pipelines to run.
+        :param aliases: the steps, by id, that are equivalent to another step
+            and are not run: their outputs are those of the other step.  See
+            `lib.planner`.
+        """
+        start = perf_counter()
+        outputs = _AliasedOutputs(aliases)
+        last_steps = [pipeline.last_step for pipeline in pipelines]
+        steps, cached_steps = _steps_to_run(last_steps, self.store, outputs)
+        profiler = StepProfiler(self.trace_memory) if self.profile else None
+        try:
+            if isinstance(self._executor, Executor):
+                timings = self._run(self._executor, steps, last_steps, outputs, profiler)
+            else:
+                with _POOL_CLASSES[self._executor](max_workers=self.max_workers) as pool:
+                    timings = self._run(pool, steps, last_steps, outputs, profiler)
+        finally:
+            duration = perf_counter() - start
+            profile = profiler.stop(duration) if profiler is not None else None
+            if self.store is not None:
+                self.store.unpin(step.version_hash() for step in cached_steps)
+
+        if len(pipelines) == 1:
+            return [PipelineRun(pipelines[0], outputs, timings, duration, cached_steps, profile)]
+
+        runs = []
+        for pipeline in pipelines:
+            step_ids = {id(outputs.canonical(step)) for step in pipeline.steps()}
+            runs.append(PipelineRun(
+                pipeline, outputs, [timing for timing in timings if id(timing.step) in step_ids],
+                duration, [step for step in cached_steps if id(step) in step_ids], profile))
+        return runs
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+"""
+I/O instrumentation for source readers.
+
+An `InstrumentedReader` wraps any `AbstractSourceReader` and records the rows
+and batches it produces, the bytes it reads from files, the time spent reading
+split into time spent waiting for file data and time spent parsing it, and the
+size of the largest batch.  Statistics are aggregated per `uri` and `query` in
+a `ReaderStatistics` and can be exported as JSON.
+
+Time is measured per batch, or per `RECORDS_PER_MEASUREMENT` records, and per
+buffer of file data, so that the overhead is low enough to leave enabled.
+"""
+
+from itertools import islice
+import json
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from lib._fileio import io_stats
+from lib.batches import DEFAULT_BATCH_SIZE, RecordBatch
+from lib.definitions import AbstractSourceReader, SourceReaderWrapper
+
+# Number of records pulled from a reader between two time measurements.
+RECORDS_PER_MEASUREMENT = 1024
+
+
+class ReadStats(object):
+    """Statistics of the reads of a source."""
+    __slots__ = ('uri', 'query', 'reads', 'rows', 'batches', 'bytes_read', 'read_time',
+                 'io_time', 'peak_batch_bytes')
+
+    def __init__(self, uri: str, query: str):
+        self.uri = uri
+        self.query = query
+        self.reads = 0
+        self.rows = 0
+        self.batches = 0
+        self.bytes_read = 0
+        # Total time spent producing output, including `io_time`.
+        self.read_time = 0.0
+        # Time spent waiting for file data.
+        self.io_time = 0.0
+        self.peak_batch_bytes = 0
+
+    def add_io(self, num_bytes: int, seconds: float):
+        self.bytes_read += num_bytes
+        self.io_time += seconds
+
+    @property
+    def parse_time(self) -> float:
+        return max(self.read_time - self.io_time, 0.0)
+
+    def merge(self, other: 'ReadStats'):
+        self.reads += other.reads
+        self.rows += other.rows
+        self.batches += other.batches
+        self.bytes_read += other.bytes_read
+        self.read_time += other.read_time
+        self.io_time += other.io_time
+        self.peak_batch_bytes = max(self.peak_batch_bytes, other.peak_batch_bytes)
+
+    def to_dict(self) -> Dict:
+        return {
+            'uri': self.uri,
+            'query': self.query,
+            'reads': self.reads,
+            'rows': self.rows,
+            'batches': self.batches,
+            'bytes_read': self.bytes_read,
+            'read_time': self.read_time,
+            'io_time': self.io_time,
+            'parse_time': self.parse_time,
+            'peak_batch_bytes': self.peak_batch_bytes,
+            'rows_per_second': self.rows / self.read_time if self.read_time else None,
+            'bytes_per_second': self.bytes_read / self.read_time if self.read_time else None,
+        }
+
+    def __repr__(self):
+        return '{}({}:{}, {} rows, {} bytes in {:.3f}s)'.format(
+            self.__class__.__name__, self.uri, self.query, self.rows, self.bytes_read, self.read_time)
+
+
+class ReaderStatistics(object):
+    """Statistics of the reads of sources, aggregated per `uri` and `query`."""
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = Lock()
+
+    def add(self, stats: ReadStats):
+        with self._lock:
+            total = self._stats.get((stats.uri, stats.query), None)
+            if total is None:
+                total = self._stats[stats.uri, stats.query] = ReadStats(stats.uri, stats.query)
+            total.merge(stats)
+
+    def get(self, uri: str, query: str) -> ReadStats:
+        return self._stats.get((uri, query), None)
+
+    def items(self) -> List[Tuple[Tuple[str, str], ReadStats]]:
+        with self._lock:
+            return sorted(self._stats.items())
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def to_dicts(self) -> List[Dict]:
+        return [stats.to_dict() for _, stats in self.items()]
+
+    def to_json(self, **kwargs) -> str:
+        """Export the statistics as a JSON list; keyword arguments are passed to `json.dumps`."""
+        return json.dumps(self.to_dicts(), **kwargs)
+
+
+# The statistics that readers are instrumented with by default.
+reader_statistics = ReaderStatistics()
+
+
+def _instrumented(stats: ReadStats, chunks: Iterator, account: Callable,
+                  statistics: ReaderStatistics) -> Iterator:
+    # Each chunk is pulled with the I/O statistics of files set to `stats`,
+    # since readers open and read files lazily while producing output.
+    try:
+        while True:
+            start = perf_counter()
+            token = io_stats.set(stats)
+            try:
+                chunk = next(chunks, None)
+            finally:
+                io_stats.reset(token)
+                stats.read_time += perf_counter() - start
+
+            if chunk is None:
+                break
+            account(chunk)
+            yield chunk
+    finally:
+        statistics.add(stats)
+
+
+class InstrumentedReader(SourceReaderWrapper):
+    """A reader that records statistics of the reads of another reader."""
+
+    def __init__(self, reader: AbstractSourceReader,
+                 statistics: ReaderStatistics=reader_statistics):
+        super().__init__(reader)
+        self.statistics = statistics
+
+    def _stats(self, query: str) -> ReadStats:
+        stats = ReadStats(self.uri, query if query is not None else self.query)
+        stats.reads = 1
+        return stats
+
+    def read(self, query: str=None):
+        stats = self._stats(query)
+        records = iter(self.reader.read(query if query is not None else self.query))
+        chunks = iter(lambda: list(islice(records, RECORDS_PER_MEASUREMENT)) or None, None)
+
+        def account(chunk):
+            stats.rows += len(chunk)
+
+        for chunk in _instrumented(stats, chunks, account, self.statistics):
+            yield from chunk
+
+    def read_batches(self, query: str=None, struct_type=None,
+                     batch_size: int=DEFAULT_BATCH_SIZE) -> Iterator[RecordBatch]:
+        stats = self._stats(query)
+        batches = iter(self.reader.read_batches(query, struct_type, batch_size))
+
+        def account(batch):
+            stats.rows += len(batch)
+            stats.batches += 1
+            stats.peak_batch_bytes = max(stats.peak_batch_bytes, batch.nbytes)
+
+        return _instrumented(stats, batches, account, self.statistics)
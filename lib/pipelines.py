@@ -1,10 +1,39 @@
 #!/usr/bin/env python3
 
 from contextlib import contextmanager
+from hashlib import sha256
+import json
+from typing import Dict, FrozenSet, List, Optional
 
-from ._pipelinecontext import MethodCall, StepOutputAccess, PipelineStepContext
-from common import digests_xor, hash_to_sha1_digest
+from ._pipelinecontext import MethodCall, StepOutputAccess, StepOutputReference, PipelineStepContext
 from lib import PipelineError
+from lib.execution import PipelineExecutor, PipelineRun
+from lib.pushdown import consumed_fields
+from lib.store import ResultStore
+import lib.types as mezuri_types
+
+
+def _canonical_argument(value):
+    """
+    Return a JSON-serializable form of an argument of a method call that
+    identifies it independently of the process: outputs of steps by the
+    version hash of their step, their name and their type, and types by their
+    fingerprint.
+    """
+    if isinstance(value, StepOutputReference):
+        return {'step': value.step._version_hash, 'output': value.name,
+                'type': value.type_.fingerprint}
+    if isinstance(value, mezuri_types.AbstractMezuriSerializable):
+        return {'fingerprint': value.fingerprint}
+    return {'value': value}
+
+
+def _canonical_method_call(method_call: MethodCall) -> Dict:
+    return {
+        'method': method_call.method,
+        'inputs': {name: _canonical_argument(value) for name, value in method_call.inputs.items()},
+        'outputs': {name: type_.fingerprint for name, type_ in method_call.output_specs.items()},
+    }
 
 
 class PipelineStep(object):
@@ -19,26 +48,92 @@ class PipelineStep(object):
         self._component_initialized = False
         self._method_calls = []
         self._output = None
+        self._output_references = None
         self._prev_steps = set()
+        self._version_hash = None
 
     def __repr__(self):
         return '{}()'.format(self.__class__.__name__)
 
     def __eq__(self, other: 'PipelineStep'):
-        return (self._method_calls == other._method_calls and
-                self._prev_steps == other._prev_steps)
+        """
+        Steps are equal if they have the same version hash: the same component,
+        method calls and previous steps.  Comparing version hashes rather than
+        the previous steps themselves lets steps of any depth be compared.
+        """
+        if not isinstance(other, PipelineStep):
+            return NotImplemented
+        return self is other or self.version_hash() == other.version_hash()
 
-    def version_hash(self):
-        component_hash = hash(self._component)
-        method_calls_hash = hash(tuple(self._method_calls))
-        return digests_xor(hash_to_sha1_digest(component_hash),
-                           hash_to_sha1_digest(method_calls_hash),
-                           *sorted(map(lambda step: step.version_hash(), self._prev_steps)))
+    def __hash__(self):
+        return hash(self.version_hash())
+
+    def _input_steps(self) -> Dict[int, 'PipelineStep']:
+        """Return the steps whose outputs are passed to this step, by their ids."""
+        steps = {}
+        for method_call in self._method_calls:
+            for value in method_call.inputs.values():
+                if isinstance(value, StepOutputReference):
+                    steps.setdefault(id(value.step), value.step)
+        return steps
+
+    def _compute_version_hash(self) -> str:
+        input_steps = self._input_steps()
+        previous = [step._version_hash for step in input_steps.values()]
+        input_hashes = set(previous)
+        previous.extend(step._version_hash for step in self._prev_steps
+                        if id(step) not in input_steps and step._version_hash not in input_hashes)
+        encoded = json.dumps({
+            'component': list(self._component.info) if self._component is not None else None,
+            'calls': [_canonical_method_call(method_call) for method_call in self._method_calls],
+            'previous': sorted(previous),
+        }, sort_keys=True, separators=(',', ':'))
+        return sha256(encoded.encode()).hexdigest()
+
+    def version_hash(self) -> str:
+        """
+        Return the version hash of this step: the SHA-256 digest of a canonical
+        encoding of its component, its method calls and the hashes of the steps
+        it uses the outputs of.  It is the same in every process.
+
+        The hash of each step is computed once, iteratively rather than
+        recursively so that pipelines of any depth can be hashed, and cached
+        until the step changes.
+        """
+        if self._version_hash is not None:
+            return self._version_hash
+
+        stack = [self]
+        while stack:
+            step = stack[-1]
+            if step._version_hash is not None:
+                stack.pop()
+                continue
+
+            unhashed = [prev_step for prev_step in step._dependencies()
+                        if prev_step._version_hash is None]
+            if unhashed:
+                stack.extend(unhashed)
+                continue
+
+            stack.pop()
+            step._version_hash = step._compute_version_hash()
+        return self._version_hash
 
     @property
-    def output(self):
+    def output(self) -> Dict[str, StepOutputReference]:
+        """
+        The outputs of this step, to be passed to the components of later
+        steps.  Each output is a reference to this step and the type of the
+        output.
+        """
         PipelineStepContext().add_step_output_access_in_context(StepOutputAccess(self))
-        return self._output
+        if self._output is None:
+            return None
+        if self._output_references is None:
+            self._output_references = {name: StepOutputReference(self, name, type_)
+                                       for name, type_ in self._output.items()}
+        return self._output_references
 
     def _validate_and_record_method_call(self, method_call: MethodCall):
         component_class = method_call.class_
@@ -59,9 +154,22 @@ class PipelineStep(object):
             self._output = method_call.output_specs
 
         self._method_calls.append(method_call)
+        self._version_hash = None
+
+    def _dependencies(self) -> List['PipelineStep']:
+        """
+        Return the steps whose outputs this step uses or accesses, each step
+        object once.  Steps that are equal (see `__eq__`) but distinct are all
+        included, unlike in `_prev_steps`.
+        """
+        dependencies = self._input_steps()
+        for prev_step in self._prev_steps:
+            dependencies.setdefault(id(prev_step), prev_step)
+        return list(dependencies.values())
 
     def _record_step_output_access(self, step_output_access: StepOutputAccess):
         self._prev_steps.add(step_output_access.step)
+        self._version_hash = None
 
     @contextmanager
     def context(self):
@@ -86,7 +194,71 @@ class Pipeline(object):
         self.last_step = last_step
 
     def __eq__(self, other: 'Pipeline'):
-        return other.last_step == self.last_step
+        """Pipelines are equal if their last steps have the same version hash."""
+        if not isinstance(other, Pipeline):
+            return NotImplemented
+        return self.version_hash() == other.version_hash()
 
     def version_hash(self):
         return self.last_step.version_hash()
+
+    def steps(self) -> List[PipelineStep]:
+        """Return all steps of this pipeline, with every step after the steps it depends on."""
+        ordered = []
+        visited = set()
+        stack = [(self.last_step, False)]
+        while stack:
+            step, dependencies_done = stack.pop()
+            if dependencies_done:
+                ordered.append(step)
+                continue
+            if id(step) in visited:
+                continue
+
+            visited.add(id(step))
+            stack.append((step, True))
+            stack.extend((prev_step, False) for prev_step in step._dependencies()
+                         if id(prev_step) not in visited)
+        return ordered
+
+    def consumed_fields(self, step: PipelineStep) -> Optional[FrozenSet[str]]:
+        """
+        Return the record fields that the steps using the output of a step
+        declare for the arguments they pass it to, or None if all fields may
+        be consumed.  This is the projection that `PipelineExecutor` pushes
+        down into the reader of a source step.
+        """
+        if step is self.last_step:
+            return None
+        return consumed_fields(step, [consumer for consumer in self.steps()
+                                      if any(prev_step is step
+                                             for prev_step in consumer._dependencies())])
+
+    def save(self, file):
+        """
+        Save the compiled plan of this pipeline to a file, given as a path or
+        a binary file object.  See `lib.plans`.
+        """
+        from lib.plans import save_plan
+        save_plan(self, file)
+
+    @classmethod
+    def load(cls, file, verify: bool=False) -> 'Pipeline':
+        """
+        Load a pipeline from a plan file saved by `save`, without running
+        definitions or contacting the registry.
+        """
+        from lib.plans import load_plan
+        return load_plan(file, verify)
+
+    def run(self, resolver, executor='thread', max_workers: int=None,
+            store: ResultStore=None, streaming: bool=False,
+            profile: bool=False) -> PipelineRun:
+        """
+        Run the steps of this pipeline, independent steps concurrently, and
+        skip the steps whose outputs are in `store`.  See
+        `lib.execution.PipelineExecutor` for the arguments.
+        """
+        return PipelineExecutor(resolver, executor, max_workers, store, streaming,
+                                profile=profile).run(self)
+
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""
+Common-subexpression elimination across pipelines.
+
+Pipelines often share steps: the same source read with the same query, the
+same cleaning operators with the same parameters.  Steps that compute the
+same thing have the same version hash, in the same pipeline or in different
+ones, so `merge_pipelines` merges pipelines into a single DAG in which each
+distinct step appears once: the first step found with a version hash is run,
+and the others are aliases of it, whose outputs are its outputs.  Running the
+merged pipelines runs each distinct step once and passes its outputs to every
+step that uses them, in every pipeline.
+"""
+
+from collections import Counter
+from typing import Dict, List, Sequence
+
+from lib.execution import PipelineExecutor, PipelineRun
+from lib.pipelines import Pipeline
+from lib.store import ResultStore
+
+
+class MergedRun(object):
+    """The runs of merged pipelines, and the work that merging them saved."""
+
+    def __init__(self, merged: 'MergedPipelines', runs: List[PipelineRun]):
+        self.merged = merged
+        self.runs = runs
+
+    @property
+    def duration(self) -> float:
+        return self.runs[0].duration if self.runs else 0.0
+
+    def saved_time(self) -> float:
+        """
+        The time that running each step that was not run would have taken,
+        estimated as the time the step run in its place took.
+        """
+        durations = {}
+        for run in self.runs:
+            for timing in run.timings:
+                durations[id(timing.step)] = timing.duration
+        return sum(durations.get(id(step), 0.0) for step in self.merged.saved_steps())
+
+    def report(self) -> Dict:
+        report = self.merged.savings()
+        report['duration'] = self.duration
+        report['saved_time'] = self.saved_time()
+        return report
+
+
+class MergedPipelines(object):
+    """Pipelines merged into a DAG in which each distinct step appears once."""
+
+    def __init__(self, pipelines: Sequence[Pipeline]):
+        self.pipelines = list(pipelines)
+        # The step that is run for each version hash.
+        self._steps = {}
+        # The steps that are not run, by id, and the equivalent steps that are.
+        self.aliases = {}
+        # The number of pipelines each step that is run is used in, by version hash.
+        self._uses = Counter()
+        # The step that is run in place of each step of the pipelines that is
+        # not run: aliases, and steps shared as the same object by pipelines.
+        self._saved_steps = []
+        self._num_steps = 0
+
+        for pipeline in self.pipelines:
+            pipeline_hashes = set()
+            for step in pipeline.steps():
+                self._num_steps += 1
+                version_hash = step.version_hash()
+                pipeline_hashes.add(version_hash)
+                if version_hash not in self._steps:
+                    self._steps[version_hash] = step
+                    continue
+                step_run = self._steps[version_hash]
+                self._saved_steps.append(step_run)
+                if step_run is not step:
+                    self.aliases[id(step)] = step_run
+            self._uses.update(pipeline_hashes)
+
+    def steps(self) -> List:
+        """Return the distinct steps of the merged pipelines, which are run."""
+        return list(self._steps.values())
+
+    def saved_steps(self) -> List:
+        """
+        Return the step that is run in place of each step of the pipelines
+        that is not run, once for each step that is not.
+        """
+        return list(self._saved_steps)
+
+    def shared_steps(self) -> List:
+        """Return the steps that are used in more than one of the pipelines."""
+        return [step for version_hash, step in self._steps.items() if self._uses[version_hash] > 1]
+
+    def savings(self) -> Dict:
+        """Return the number of steps of the pipelines and how many of them are not run."""
+        return {
+            'pipelines': len(self.pipelines),
+            'steps': self._num_steps,
+            'distinct_steps': len(self._steps),
+            'shared_steps': len(self.shared_steps()),
+            'saved_steps': len(self._saved_steps),
+        }
+
+    def run(self, resolver, executor='thread', max_workers: int=None,
+            store: ResultStore=None, streaming: bool=False, profile: bool=False) -> MergedRun:
+        """
+        Run the merged pipelines, each distinct step once.  See
+        `lib.execution.PipelineExecutor` for the arguments.
+        """
+        pipeline_executor = PipelineExecutor(resolver, executor, max_workers, store, streaming,
+                                             profile=profile)
+        return MergedRun(self, pipeline_executor.run_all(self.pipelines, self.aliases))
+
+
+def merge_pipelines(pipelines: Sequence[Pipeline]) -> MergedPipelines:
+    """Merge pipelines by deduplicating the steps that have the same version hash."""
+    return MergedPipelines(pipelines)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+"""
+Compiled pipeline plans.
+
+A plan is everything a `Pipeline` is made of once its definition code has
+run: its steps, their method calls, the edges between them, the components
+with their specifications, and the version hashes of the steps.  Loading a
+plan rebuilds the pipeline without running definitions, contacting the
+registry or validating calls again.  A plan file has the following layout:
+
+    magic  b'MZP' followed by the format version (1 byte)
+    body   zlib-compressed JSON
+
+The JSON body holds a table of the distinct types and a table of the
+distinct components of the plan, which steps refer to by index, and the
+steps in an order where every step comes after the steps it depends on, so
+that it is rebuilt in a single pass.  Arguments of method calls are encoded
+as:
+
+    [0, value]              a JSON value; arrays are loaded as tuples
+    [1, type]               a type, by index
+    [2, step, output]       an output of an earlier step, by index and name
+"""
+
+from collections import OrderedDict
+import json
+from typing import BinaryIO, Dict, List, Union
+import zlib
+
+from lib._pipelinecontext import MethodCall, StepOutputReference
+from lib.encoding import EncodingError
+from lib.pipelines import Pipeline, PipelineStep
+import lib.types as mezuri_types
+
+MAGIC = b'MZP\x01'
+
+_ARGUMENT_VALUE = 0
+_ARGUMENT_TYPE = 1
+_ARGUMENT_OUTPUT = 2
+
+
+def _plan_steps(last_step: PipelineStep) -> List[PipelineStep]:
+    """
+    Return the steps a step depends on and the step itself, with every step
+    after the steps it depends on, including the steps whose outputs were
+    only accessed.
+    """
+    ordered = []
+    visited = set()
+    stack = [(last_step, False)]
+    while stack:
+        step, dependencies_done = stack.pop()
+        if dependencies_done:
+            ordered.append(step)
+            continue
+        if id(step) in visited:
+            continue
+
+        visited.add(id(step))
+        stack.append((step, True))
+        stack.extend((prev_step, False)
+                     for prev_step in step._dependencies() + list(step._prev_steps)
+                     if id(prev_step) not in visited)
+    return ordered
+
+
+class _PlanEncoder(object):
+    def __init__(self):
+        self.types = []
+        self.type_indices = {}
+        self.components = []
+        self.component_indices = {}
+        self.step_indices = {}
+
+    def type_index(self, type_: mezuri_types.AbstractMezuriSerializable) -> int:
+        key = getattr(type_, 'layout', type_.fingerprint)
+        index = self.type_indices.get(key, None)
+        if index is None:
+            index = self.type_indices[key] = len(self.types)
+            self.types.append(type_.serialize())
+        return index
+
+    def component_index(self, component) -> int:
+        index = self.component_indices.get(component.info, None)
+        if index is None:
+            index = self.component_indices[component.info] = len(self.components)
+            self.components.append([component.data_type, list(component.serialize().contents),
+                                    component._specs, component._version_hash])
+        return index
+
+    def argument(self, value) -> List:
+        if isinstance(value, StepOutputReference):
+            return [_ARGUMENT_OUTPUT, self.step_indices[id(value.step)], value.name]
+        if isinstance(value, mezuri_types.AbstractMezuriSerializable):
+            return [_ARGUMENT_TYPE, self.type_index(value)]
+        return [_ARGUMENT_VALUE, value]
+
+    def method_call(self, method_call: MethodCall) -> List:
+        return [method_call.method,
+                {name: self.argument(value) for name, value in method_call.inputs.items()},
+                [[name, self.type_index(type_)]
+                 for name, type_ in method_call.output_specs.items()]]
+
+    def step(self, step: PipelineStep) -> Dict:
+        encoded = {
+            'component': self.component_index(step._component),
+            'calls': [self.method_call(method_call) for method_call in step._method_calls],
+            'previous': sorted(self.step_indices[id(prev_step)] for prev_step in step._prev_steps),
+            'hash': step.version_hash(),
+        }
+        self.step_indices[id(step)] = len(self.step_indices)
+        return encoded
+
+
+def encode_plan(pipeline: Pipeline) -> bytes:
+    """Encode the plan of a pipeline.  Literal arguments of method calls must be JSON values."""
+    encoder = _PlanEncoder()
+    steps = [encoder.step(step) for step in _plan_steps(pipeline.last_step)]
+    try:
+        body = json.dumps({'types': encoder.types, 'components': encoder.components,
+                           'steps': steps}, separators=(',', ':'))
+    except TypeError as e:
+        raise EncodingError('cannot encode plan: {}'.format(e))
+    return MAGIC + zlib.compress(body.encode())
+
+
+def _literal(value):
+    if isinstance(value, list):
+        return tuple(_literal(item) for item in value)
+    if isinstance(value, dict):
+        return {key: _literal(item) for key, item in value.items()}
+    return value
+
+
+def _decode_component(data_type: str, contents: List, specs: Dict, version_hash: str):
+    deserializer = mezuri_types.deserializers.get(data_type, None)
+    if deserializer is None:
+        raise EncodingError('unknown component type {}'.format(data_type))
+    component = deserializer.deserialize(contents)
+    component._specs = specs
+    component._version_hash = version_hash
+    return component
+
+
+def decode_plan(data: bytes, verify: bool=False) -> Pipeline:
+    """
+    Decode a plan encoded by `encode_plan` into a pipeline.  The version
+    hashes of the steps are taken from the plan, unless `verify` is set, in
+    which case they are computed and checked against the plan.
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise EncodingError('data is not an encoded pipeline plan')
+    try:
+        plan = json.loads(zlib.decompress(data[len(MAGIC):]).decode())
+    except (zlib.error, ValueError) as e:
+        raise EncodingError('invalid pipeline plan: {}'.format(e))
+
+    try:
+        return _decode_pipeline(plan, verify)
+    except EncodingError:
+        raise
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError) as e:
+        raise EncodingError('invalid pipeline plan: {!r}'.format(e))
+
+
+def _decode_pipeline(plan: Dict, verify: bool) -> Pipeline:
+    """Rebuild the pipeline of a decoded plan body.  See `decode_plan`."""
+    types = [mezuri_types.get_deserialized(type_) for type_ in plan['types']]
+    components = [_decode_component(*component) for component in plan['components']]
+    output_specs = {}
+    steps = []
+
+    def argument(encoded: List):
+        kind = encoded[0]
+        if kind == _ARGUMENT_OUTPUT:
+            return steps[encoded[1]]._output_references[encoded[2]]
+        if kind == _ARGUMENT_TYPE:
+            return types[encoded[1]]
+        return _literal(encoded[1])
+
+    for encoded_step in plan['steps']:
+        step = PipelineStep()
+        component = components[encoded_step['component']]
+        step._component = component
+        for method, inputs, outputs in encoded_step['calls']:
+            # Calls of the same method share their output specifications, as
+            # they do when they are made through the same method proxy.
+            key = (encoded_step['component'], method, tuple(map(tuple, outputs)))
+            specs = output_specs.get(key, None)
+            if specs is None:
+                specs = output_specs[key] = OrderedDict((name, types[index])
+                                                        for name, index in outputs)
+            step._method_calls.append(MethodCall(
+                component, method, {name: argument(value) for name, value in inputs.items()},
+                specs))
+            if method == '__init__':
+                step._component_initialized = True
+            else:
+                step._output = specs
+
+        step._prev_steps = {steps[index] for index in encoded_step['previous']}
+        step._output_references = {name: StepOutputReference(step, name, type_)
+                                   for name, type_ in (step._output or {}).items()}
+        step._version_hash = encoded_step['hash']
+        step._is_set = True
+        steps.append(step)
+
+    if not steps:
+        raise EncodingError('pipeline plan has no steps')
+    if verify:
+        for index, (step, encoded_step) in enumerate(zip(steps, plan['steps'])):
+            step._version_hash = None
+            if step.version_hash() != encoded_step['hash']:
+                raise EncodingError('version hash of step {} does not match the plan'.format(index))
+    return Pipeline(steps[-1])
+
+
+def save_plan(pipeline: Pipeline, file: Union[str, BinaryIO]):
+    """Save the plan of a pipeline to a file, given as a path or a binary file object."""
+    data = encode_plan(pipeline)
+    if isinstance(file, str):
+        with open(file, 'wb') as f:
+            f.write(data)
+    else:
+        file.write(data)
+
+
+def load_plan(file: Union[str, BinaryIO], verify: bool=False) -> Pipeline:
+    """Load a pipeline from a plan file, given as a path or a binary file object."""
+    if isinstance(file, str):
+        with open(file, 'rb') as f:
+            data = f.read()
+    else:
+        data = file.read()
+    return decode_plan(data, verify)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+Read-ahead prefetching for source readers.
+
+A `PrefetchingReader` wraps any `AbstractSourceReader` and reads its output
+ahead of the consumer, on a background thread, into a queue of at most `depth`
+record batches (or chunks of records), so that reading and downstream
+computation overlap.  Async consumers can use `read_batches_async`, which reads
+ahead in an asyncio task if the wrapped reader has a `read_batches_async`
+async iterator of its own, and on a background thread otherwise.
+"""
+
+import asyncio
+from contextvars import copy_context
+from itertools import islice
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from typing import AsyncIterator, Callable, Iterable, Iterator
+
+from lib.batches import DEFAULT_BATCH_SIZE, RecordBatch
+from lib.definitions import AbstractSourceReader, SourceReaderWrapper
+
+DEFAULT_DEPTH = 4
+# Number of records per item of the queue when prefetching records.
+RECORDS_PER_CHUNK = 1024
+
+_DONE = object()
+
+
+class Prefetcher(object):
+    """
+    An iterator over the items of an iterable that are read ahead on a
+    background thread into a queue of at most `depth` items.  Reading starts
+    as soon as the prefetcher is created and stops when it is closed.
+    """
+
+    def __init__(self, produce: Callable[[], Iterable], depth: int=DEFAULT_DEPTH):
+        self._items = Queue(maxsize=depth)
+        self._stopped = Event()
+        self._done = False
+
+        # The background thread runs in a copy of the current context, so that
+        # context variables such as lib._fileio.io_stats apply to it.
+        self._thread = Thread(target=copy_context().run, args=(self._read_ahead, produce),
+                              daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._items.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _read_ahead(self, produce: Callable[[], Iterable]):
+        items = None
+        try:
+            items = iter(produce())
+            for item in items:
+                if not self._put(item):
+                    return
+            self._put(_DONE)
+        except BaseException as e:
+            self._put(e)
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+
+        item = self._items.get()
+        if item is _DONE or isinstance(item, BaseException):
+            self.close()
+            if item is _DONE:
+                raise StopIteration
+            raise item
+        return item
+
+    def close(self):
+        self._done = True
+        if not self._stopped.is_set():
+            self._stopped.set()
+            try:
+                while True:
+                    self._items.get_nowait()
+            except Empty:
+                pass
+
+    def __del__(self):
+        self.close()
+
+
+class PrefetchingReader(SourceReaderWrapper):
+    """
+    A reader that reads the output of another reader ahead of its consumer.
+    To record statistics of the reads themselves, rather than of the time the
+    consumer waits for them, wrap an `InstrumentedReader` in this reader.
+    """
+
+    def __init__(self, reader: AbstractSourceReader, depth: int=DEFAULT_DEPTH):
+        """
+        :param reader: the reader to read ahead.
+        :param depth: the maximum number of batches, or chunks of
+            `RECORDS_PER_CHUNK` records, read ahead.
+        """
+        super().__init__(reader)
+        self.depth = depth
+
+    def read(self, query: str=None) -> Iterator:
+        query = query if query is not None else self.query
+
+        def chunks():
+            records = iter(self.reader.read(query))
+            return iter(lambda: list(islice(records, RECORDS_PER_CHUNK)), [])
+
+        prefetcher = Prefetcher(chunks, self.depth)
+        try:
+            for chunk in prefetcher:
+                yield from chunk
+        finally:
+            prefetcher.close()
+
+    def read_batches(self, query: str=None, struct_type=None,
+                     batch_size: int=DEFAULT_BATCH_SIZE) -> Iterator[RecordBatch]:
+        """
+        Return an iterator over the batches of the wrapped reader, which are
+        read ahead as soon as this method is called.  Close the iterator to
+        stop reading ahead if it is not consumed entirely.
+        """
+        return Prefetcher(lambda: self.reader.read_batches(query, struct_type, batch_size),
+                           self.depth)
+
+    async def read_batches_async(self, query: str=None, struct_type=None,
+                                 batch_size: int=DEFAULT_BATCH_SIZE) -> AsyncIterator[RecordBatch]:
+        """An async iterator over the batches of the wrapped reader, which are read ahead."""
+        read_batches_async = getattr(self.reader, 'read_batches_async', None)
+        if read_batches_async is None:
+            prefetcher = Prefetcher(
+                lambda: self.reader.read_batches(query, struct_type, batch_size), self.depth)
+            loop = asyncio.get_running_loop()
+            try:
+                while True:
+                    batch = await loop.run_in_executor(None, next, prefetcher, None)
+                    if batch is None:
+                        return
+                    yield batch
+            finally:
+                prefetcher.close()
+
+        batches = asyncio.Queue(maxsize=self.depth)
+
+        async def read_ahead():
+            try:
+                async for batch in read_batches_async(query, struct_type, batch_size):
+                    await batches.put(batch)
+                await batches.put(_DONE)
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:
+                await batches.put(e)
+
+        task = asyncio.ensure_future(read_ahead())
+        try:
+            while True:
+                batch = await batches.get()
+                if batch is _DONE:
+                    return
+                if isinstance(batch, BaseException):
+                    raise batch
+                yield batch
+        finally:
+            task.cancel()
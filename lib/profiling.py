@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+"""
+Per-step profiling of pipeline runs.
+
+When a `PipelineExecutor` profiles a run, each step records:
+- its wall time and the CPU time of the thread that ran it,
+- its queue wait, the time between all its inputs being available and it
+  starting to run,
+- the number of rows of its inputs from earlier steps and of its outputs,
+  for the values that have a length,
+- its peak memory: the peak of the memory traced by `tracemalloc` while it
+  ran, above the level when it started.  Steps that run concurrently on
+  threads share the memory of the process, so each of them is attributed the
+  peak of the process during its run.
+
+A `RunProfile` computes the critical path of the run: the chain of steps,
+from the last one back, in which every step is the dependency that finished
+last, and so delayed the next step.  These are the steps that determine how
+long the run takes.  It can be written as a JSON report and as a Chrome trace
+event file, which chrome://tracing and Perfetto display as a timeline.
+
+Tracing memory slows allocations down.  Profile with `trace_memory=False` to
+measure time only.
+"""
+
+import json
+from threading import Lock
+from time import perf_counter, thread_time
+import tracemalloc
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+_memory_lock = Lock()
+# The peak of the traced memory seen by each step running in this process, by token.
+_memory_peaks = {}
+# Whether `run_profiled` started tracing memory in this process, as it does in
+# the processes of a process pool, and must stop it once no step is traced.
+_started_tracing = False
+
+
+class StepMeasurement(object):
+    """What is measured in the thread or process that runs a step."""
+    __slots__ = ('cpu_time', 'input_rows', 'output_rows', 'peak_memory')
+
+    def __init__(self, cpu_time: float, input_rows: Optional[int], output_rows: Optional[int],
+                 peak_memory: Optional[int]):
+        self.cpu_time = cpu_time
+        self.input_rows = input_rows
+        self.output_rows = output_rows
+        self.peak_memory = peak_memory
+
+
+def _rows(values: Iterable) -> Optional[int]:
+    """Return the total length of the values that have one, or None if none have."""
+    total = None
+    for value in values:
+        if isinstance(value, (str, bytes, dict)):
+            continue
+        try:
+            length = len(value)
+        except TypeError:
+            continue
+        total = (total or 0) + length
+    return total
+
+
+def _fold_memory_peak():
+    """Record the current peak of traced memory for every running step, and reset it."""
+    peak = tracemalloc.get_traced_memory()[1]
+    for token, step_peak in _memory_peaks.items():
+        if peak > step_peak:
+            _memory_peaks[token] = peak
+    tracemalloc.reset_peak()
+
+
+def run_profiled(run_step: Callable, arguments: Tuple, input_names: Sequence[str],
+                 trace_memory: bool):
+    """
+    Call `run_step(*arguments)`, where `arguments[3]` holds the arguments
+    of the method of a step, and return its result and a `StepMeasurement`.
+    `input_names` are the names of the arguments that are outputs of earlier
+    steps.
+    """
+    global _started_tracing
+    token = None
+    if trace_memory:
+        with _memory_lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _started_tracing = True
+            _fold_memory_peak()
+            token = object()
+            _memory_peaks[token] = start_memory = tracemalloc.get_traced_memory()[0]
+
+    start_cpu = thread_time()
+    try:
+        result = run_step(*arguments)
+    finally:
+        cpu_time = thread_time() - start_cpu
+        peak_memory = None
+        if token is not None:
+            with _memory_lock:
+                _fold_memory_peak()
+                peak_memory = _memory_peaks.pop(token) - start_memory
+                if _started_tracing and not _memory_peaks:
+                    tracemalloc.stop()
+                    _started_tracing = False
+
+    method_arguments = arguments[3]
+    measurement = StepMeasurement(cpu_time, _rows(method_arguments[name] for name in input_names),
+                                  _rows(result[0].values()), peak_memory)
+    return result, measurement
+
+
+class StepProfile(object):
+    """The profile of a step in a run, with times in seconds since the start of the run."""
+    __slots__ = ('step', 'name', 'ready', 'start', 'end', 'cpu_time', 'input_rows',
+                 'output_rows', 'peak_memory')
+
+    def __init__(self, step, name: str, ready: float, start: float, end: float,
+                 measurement: StepMeasurement=None):
+        self.step = step
+        self.name = name
+        self.ready = ready
+        self.start = start
+        self.end = end
+        self.cpu_time = measurement.cpu_time if measurement else None
+        self.input_rows = measurement.input_rows if measurement else None
+        self.output_rows = measurement.output_rows if measurement else None
+        self.peak_memory = measurement.peak_memory if measurement else None
+
+    @property
+    def wall_time(self) -> float:
+        return self.end - self.start
+
+    @property
+    def queue_wait(self) -> float:
+        return max(self.start - self.ready, 0.0)
+
+    def to_dict(self) -> Dict:
+        return {
+            'name': self.name,
+            'version_hash': self.step.version_hash(),
+            'ready': self.ready,
+            'start': self.start,
+            'end': self.end,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'queue_wait': self.queue_wait,
+            'input_rows': self.input_rows,
+            'output_rows': self.output_rows,
+            'peak_memory': self.peak_memory,
+        }
+
+    def __repr__(self):
+        return '{}({}, {:.3f}s)'.format(self.__class__.__name__, self.name, self.wall_time)
+
+
+class RunProfile(object):
+    """The profiles of the steps of a run of a pipeline."""
+
+    def __init__(self, profiles: List[StepProfile], duration: float):
+        self.profiles = sorted(profiles, key=lambda profile: profile.start)
+        self.duration = duration
+        self._by_step = {id(profile.step): profile for profile in self.profiles}
+
+    def profile_of(self, step) -> StepProfile:
+        return self._by_step[id(step)]
+
+    def critical_path(self) -> List[StepProfile]:
+        """
+        Return the critical path of the run, first step first: starting from
+        the step that ended last, each step is preceded by the dependency
+        that ended last.  Steps whose outputs were taken from a store are not
+        part of the run, and end the path.
+        """
+        if not self.profiles:
+            return []
+
+        path = [max(self.profiles, key=lambda profile: profile.end)]
+        while True:
+            dependencies = [self._by_step[id(prev_step)]
+                            for prev_step in path[-1].step._dependencies()
+                            if id(prev_step) in self._by_step]
+            if not dependencies:
+                break
+            path.append(max(dependencies, key=lambda profile: profile.end))
+        path.reverse()
+        return path
+
+    def to_dict(self) -> Dict:
+        critical_path = self.critical_path()
+        indices = {id(profile): index for index, profile in enumerate(self.profiles)}
+        return {
+            'duration': self.duration,
+            'steps': [profile.to_dict() for profile in self.profiles],
+            # Indices of the steps of the critical path in 'steps'.
+            'critical_path': [indices[id(profile)] for profile in critical_path],
+            'critical_path_time': sum(profile.wall_time + profile.queue_wait
+                                      for profile in critical_path),
+        }
+
+    def write_report(self, path: str, **kwargs):
+        """Write the profile as JSON; keyword arguments are passed to `json.dump`."""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, **kwargs)
+
+    def trace_events(self) -> List[Dict]:
+        """
+        Return the profile as Chrome trace events.  Steps are laid out on as
+        few rows as do not overlap, and steps on the critical path are in the
+        'critical' category.
+        """
+        critical = {id(profile.step) for profile in self.critical_path()}
+        lane_ends = []
+        events = []
+        for profile in self.profiles:
+            lane = next((index for index, end in enumerate(lane_ends) if end <= profile.start),
+                        len(lane_ends))
+            if lane == len(lane_ends):
+                lane_ends.append(profile.end)
+            else:
+                lane_ends[lane] = profile.end
+
+            args = profile.to_dict()
+            del args['name']
+            events.append({
+                'name': profile.name,
+                'cat': 'critical' if id(profile.step) in critical else 'step',
+                'ph': 'X',
+                'ts': profile.start * 1e6,
+                'dur': profile.wall_time * 1e6,
+                'pid': 1,
+                'tid': lane,
+                'args': args,
+            })
+        return events
+
+    def write_chrome_trace(self, path: str):
+        """Write the profile as a Chrome trace event file."""
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}, f)
+
+    def report(self) -> str:
+        """Return a text summary of the critical path."""
+        lines = ['{:.3f}s, critical path:'.format(self.duration)]
+        for profile in self.critical_path():
+            lines.append('  {:<40} wait {:8.3f}s  run {:8.3f}s'.format(
+                profile.name, profile.queue_wait, profile.wall_time))
+        return '\n'.join(lines)
+
+
+class StepProfiler(object):
+    """Collects the profiles of the steps of a run, as its executor runs them."""
+
+    def __init__(self, trace_memory: bool=True):
+        self.trace_memory = trace_memory
+        self._ready = {}
+        self._profiles = []
+        self._started_tracing = False
+        self._start = None
+
+    def start(self, start: float):
+        """Start profiling a run that started at `start`, as given by `perf_counter`."""
+        self._start = start
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def stop(self, duration: float) -> RunProfile:
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return RunProfile(self._profiles, duration)
+
+    def ready(self, step):
+        self._ready[id(step)] = perf_counter() - self._start
+
+    def add(self, step, name: str, start: float, end: float,
+            measurement: StepMeasurement=None):
+        """Add the profile of a step, with its start and end since the start of the run."""
+        self._profiles.append(StepProfile(step, name, self._ready.get(id(step), start), start,
+                                          end, measurement))
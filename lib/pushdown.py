@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""
+Projection and predicate pushdown for source readers.
+
+A `Pushdown` describes the columns of a source that are actually consumed and
+simple predicates on declared fields that records must satisfy.  Readers that
+support it skip parsing unused columns and filter records early; SQL-backed
+readers translate it into their query.
+
+The columns consumed from the output of a step are the fields of the Struct
+types that the steps using it declare for the arguments they pass it to,
+which may be a projection of its type (see `lib.types.is_projection`).
+"""
+
+from collections import namedtuple
+from functools import reduce
+from itertools import repeat
+import operator
+from typing import Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple
+
+from lib._pipelinecontext import StepOutputReference
+from lib.batches import RecordBatch, record_struct
+import lib.types as mezuri_types
+
+_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class Predicate(namedtuple('Predicate', ['field', 'operator', 'value'])):
+    """A comparison of a field of a record with a constant value."""
+
+    def __new__(cls, field: str, operator_: str, value):
+        if operator_ not in _OPERATORS:
+            raise ValueError('unsupported operator {}'.format(operator_))
+        return super().__new__(cls, field, operator_, value)
+
+    def matches(self, record: Dict) -> bool:
+        return _OPERATORS[self.operator](record[self.field], self.value)
+
+    def matches_value(self, value) -> bool:
+        return _OPERATORS[self.operator](value, self.value)
+
+    def mask(self, column) -> Iterator[bool]:
+        """Evaluate this predicate on a whole column of values."""
+        return map(_OPERATORS[self.operator], column, repeat(self.value))
+
+    def to_sql(self) -> Tuple[str, List]:
+        """Return a SQL condition for this predicate and its parameters."""
+        return '{} {} ?'.format(quote_sql_identifier(self.field), self.operator), [self.value]
+
+
+def equal(field: str, value) -> Tuple[Predicate]:
+    return Predicate(field, '==', value),
+
+
+def in_range(field: str, low=None, high=None) -> Tuple[Predicate, ...]:
+    """Predicates for `low <= field < high`; either bound may be omitted."""
+    predicates = ()
+    if low is not None:
+        predicates += (Predicate(field, '>=', low),)
+    if high is not None:
+        predicates += (Predicate(field, '<', high),)
+    return predicates
+
+
+def quote_sql_identifier(name: str) -> str:
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+class Pushdown(namedtuple('Pushdown', ['columns', 'predicates'])):
+    """
+    The columns consumed from a source (None if all are) and the predicates
+    that its records must satisfy.
+    """
+
+    def __new__(cls, columns: Optional[Iterable[str]]=None, predicates: Iterable[Predicate]=()):
+        return super().__new__(cls, frozenset(columns) if columns is not None else None,
+                               tuple(predicates))
+
+    @property
+    def fields_to_read(self) -> Optional[FrozenSet[str]]:
+        """The fields that must be read: the consumed columns and the fields of the predicates."""
+        if self.columns is None:
+            return None
+        return self.columns.union(predicate.field for predicate in self.predicates)
+
+    def read_struct(self, type_: mezuri_types.AbstractMezuriSerializable,
+                    include_predicate_fields: bool=True) -> mezuri_types.Struct:
+        """
+        Restrict the record Struct of a type to the fields that must be read or,
+        if the predicates are applied elsewhere, to the consumed columns.
+        """
+        struct_type = record_struct(type_)
+        fields = self.fields_to_read if include_predicate_fields else self.columns
+        if fields is None:
+            return struct_type
+        return mezuri_types.Struct({name: field_type
+                                    for name, field_type in struct_type.definition.items()
+                                    if name in fields})
+
+    def matches(self, record: Dict) -> bool:
+        return all(predicate.matches(record) for predicate in self.predicates)
+
+    def project(self, record: Dict) -> Dict:
+        if self.columns is None:
+            return record
+        return {name: value for name, value in record.items() if name in self.columns}
+
+    def apply(self, records: Iterable[Dict]) -> Iterator[Dict]:
+        """Filter and project records that could not be pushed down further."""
+        if self.predicates:
+            records = filter(self.matches, records)
+        if self.columns is not None:
+            records = map(self.project, records)
+        return records
+
+    def apply_to_batch(self, batch: RecordBatch) -> RecordBatch:
+        """Filter a batch column by column and select the consumed columns."""
+        if self.predicates:
+            masks = [predicate.mask(batch.column(predicate.field)) for predicate in self.predicates]
+            batch = batch.filter(list(reduce(lambda a, b: map(operator.and_, a, b), masks)))
+        if self.columns is not None:
+            batch = batch.select([name for name in batch.field_names if name in self.columns])
+        return batch
+
+    def apply_to_batches(self, batches: Iterable[RecordBatch]) -> Iterator[RecordBatch]:
+        for batch in batches:
+            batch = self.apply_to_batch(batch)
+            if len(batch):
+                yield batch
+
+    def to_sql(self, query: str) -> Tuple[str, List]:
+        """Wrap a SQL query so that the database does the projection and filtering."""
+        columns = (', '.join(quote_sql_identifier(name) for name in sorted(self.columns))
+                   if self.columns is not None else '*')
+        sql = 'SELECT {} FROM ({})'.format(columns, query)
+        params = []
+        if self.predicates:
+            conditions = []
+            for predicate in self.predicates:
+                condition, condition_params = predicate.to_sql()
+                conditions.append(condition)
+                params.extend(condition_params)
+            sql += ' WHERE {}'.format(' AND '.join(conditions))
+        return sql, params
+
+
+def _declared_input_type(method_call, name: str, value: StepOutputReference):
+    """Return the type a component method declares for an argument, or that of the value."""
+    component = method_call.class_
+    if method_call.method in getattr(component, '_method_declarations', {}):
+        method_specs = component._method_proxy(method_call.method)._method_specs
+        return method_specs.get('input', {}).get(name, value.type_)
+    return value.type_
+
+
+def consumed_fields(step, consumers: Iterable,
+                    canonical: Callable=None) -> Optional[FrozenSet[str]]:
+    """
+    Return the record fields of the outputs of a step that `consumers`, the
+    steps using them, declare for the arguments they pass them to, or None if
+    all fields may be consumed.  `canonical` maps the steps that consumers
+    refer to to the steps run in their place, if any are.
+    """
+    fields = set()
+    for consumer in consumers:
+        for method_call in consumer._method_calls:
+            for name, value in method_call.inputs.items():
+                if not isinstance(value, StepOutputReference) or (
+                        canonical(value.step) if canonical else value.step) is not step:
+                    continue
+                try:
+                    fields.update(record_struct(
+                        _declared_input_type(method_call, name, value)).definition)
+                except TypeError:
+                    return None
+    return frozenset(fields) if fields else None
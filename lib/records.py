@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+Generated record classes for Struct types.
+
+`record_class` generates a class with `__slots__` for the fields of a Struct
+type, which takes a fraction of the memory of a dict per record.  Its
+constructors are generated code too: `from_row` converts a dict of strings,
+such as a row of `csv.DictReader`, to the declared types of the fields, and
+`row_parser` returns a function that does the same for rows given as
+sequences of strings in the order of a header, without building dicts at all.
+
+Records can be indexed by field name like dicts, so code written for dict
+records (such as `RecordBatch.from_records`) accepts them unchanged.
+
+Fields become attributes, so Structs with field names that are not
+identifiers, are keywords, start with '_' or are the names of the methods of
+records have no record class.  `record_mapper` and `row_parser` convert rows
+to dicts of values of the declared types for them instead.
+"""
+
+import keyword
+from threading import Lock
+from typing import Callable, Dict, Sequence
+
+from lib.batches import record_struct, value_parser
+import lib.types as mezuri_types
+
+_RESERVED_NAMES = frozenset(('from_row', 'from_values', 'row_parser', 'keys', 'to_dict'))
+
+_record_classes = {}
+_record_classes_lock = Lock()
+
+_CLASS_TEMPLATE = '''\
+class {class_name}(object):
+    __slots__ = {fields!r}
+    _fields = {fields!r}
+    _field_set = frozenset({fields!r})
+
+    def __init__(self, {arguments}):
+{assignments}
+
+    @classmethod
+    def from_row(cls, row):
+        return cls({parsed_values})
+
+    @classmethod
+    def from_values(cls, values):
+        return cls({values})
+
+    def __getitem__(self, name):
+        if name not in self._field_set:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def keys(self):
+        return self._fields
+
+    def to_dict(self):
+        return {{{items}}}
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return ({self_values}) == ({other_values})
+
+    def __repr__(self):
+        return '{class_name}({repr_format})'.format({self_values})
+
+    def __reduce__(self):
+        return _rebuild, (_struct_type, ({self_values}))
+'''
+
+
+def _rebuild(struct_type: mezuri_types.Struct, values: tuple):
+    return record_class(struct_type)(*values)
+
+
+def _value_expression(parser_name: str, parser: Callable, value: str) -> str:
+    return value if parser is str else '{}({})'.format(parser_name, value)
+
+
+def _invalid_field_names(struct_type: mezuri_types.Struct) -> list:
+    """Return the names of the fields of a Struct type that cannot be attributes of records."""
+    return [name for name in struct_type.definition
+            if not name.isidentifier() or keyword.iskeyword(name) or name.startswith('_') or
+            name in _RESERVED_NAMES]
+
+
+def _generate_record_class(struct_type: mezuri_types.Struct, class_name: str) -> type:
+    fields = tuple(struct_type.definition)
+    invalid = _invalid_field_names(struct_type)
+    if invalid:
+        raise ValueError('cannot generate a record class for fields {}'.format(', '.join(invalid)))
+
+    parsers = {'_parse_{}'.format(name): value_parser(type_)
+               for name, type_ in struct_type.definition.items()}
+    self_values = ''.join('self.{}, '.format(name) for name in fields)
+    source = _CLASS_TEMPLATE.format(
+        class_name=class_name,
+        fields=fields,
+        arguments=', '.join(fields),
+        assignments='\n'.join('        self.{0} = {0}'.format(name) for name in fields) or '        pass',
+        parsed_values=', '.join(_value_expression('_parse_' + name, parsers['_parse_' + name],
+                                                  'row[{!r}]'.format(name)) for name in fields),
+        values=', '.join('values[{!r}]'.format(name) for name in fields),
+        items=', '.join('{0!r}: self.{0}'.format(name) for name in fields),
+        self_values=self_values,
+        other_values=''.join('other.{}, '.format(name) for name in fields),
+        repr_format=', '.join('{}={{!r}}'.format(name) for name in fields),
+    )
+
+    namespace = dict(parsers, _rebuild=_rebuild, _struct_type=struct_type)
+    exec(source, namespace)
+    cls = namespace[class_name]
+    cls.struct_type = struct_type
+    cls._row_parsers = {}
+    cls.row_parser = classmethod(_row_parser)
+    return cls
+
+
+def _row_parser(cls, header: Sequence[str]) -> Callable[[Sequence[str]], object]:
+    """
+    Return a function that builds a record from a row of strings in the order
+    of `header`, converting each field to its declared type.  Columns that are
+    not fields of the record are ignored.
+    """
+    header = tuple(header)
+    parser = cls._row_parsers.get(header, None)
+    if parser is not None:
+        return parser
+
+    positions = {name: position for position, name in enumerate(header)}
+    missing = [name for name in cls._fields if name not in positions]
+    if missing:
+        raise KeyError('fields {} are not in the header'.format(', '.join(missing)))
+
+    parsers = {'_parse_{}'.format(name): value_parser(type_)
+               for name, type_ in cls.struct_type.definition.items()}
+    source = 'def parse(row):\n    return _cls({})\n'.format(', '.join(
+        _value_expression('_parse_' + name, parsers['_parse_' + name],
+                          'row[{}]'.format(positions[name])) for name in cls._fields))
+    namespace = dict(parsers, _cls=cls)
+    exec(source, namespace)
+    parser = cls._row_parsers[header] = namespace['parse']
+    return parser
+
+
+def record_class(type_: mezuri_types.AbstractMezuriSerializable, class_name: str='Record') -> type:
+    """
+    Return the record class for a Struct type (or a List or Stream of
+    Structs).  Classes are generated once per Struct type and order of its
+    fields; `class_name` is only used when the class is first generated.
+
+    Field names must be identifiers that do not start with '_' and are not
+    the names of the methods of records.
+    """
+    struct_type = record_struct(type_)
+    # Keyed by layout: Structs with the same fields in another order are
+    # equal, but their records take the values in a different order.
+    cls = _record_classes.get(struct_type.layout, None)
+    if cls is None:
+        with _record_classes_lock:
+            cls = _record_classes.get(struct_type.layout, None)
+            if cls is None:
+                cls = _record_classes[struct_type.layout] = _generate_record_class(struct_type,
+                                                                                   class_name)
+    return cls
+
+
+def has_record_class(type_: mezuri_types.AbstractMezuriSerializable) -> bool:
+    """Whether a Struct type (or a List or Stream of Structs) has a record class."""
+    return not _invalid_field_names(record_struct(type_))
+
+
+def record_mapper(type_: mezuri_types.AbstractMezuriSerializable) -> Callable[[Dict], object]:
+    """
+    A field mapper that converts dicts of strings to records of a Struct
+    type, or to dicts of values of the declared types if it has no record class.
+    """
+    if has_record_class(type_):
+        return record_class(type_).from_row
+
+    parsers = tuple((name, value_parser(field_type))
+                    for name, field_type in record_struct(type_).definition.items())
+    return lambda row: {name: parse(row[name]) for name, parse in parsers}
+
+
+def row_parser(type_: mezuri_types.AbstractMezuriSerializable,
+               header: Sequence[str]) -> Callable[[Sequence[str]], object]:
+    """
+    Return a function that converts rows of strings in the order of `header`
+    to records of a Struct type (see `row_parser` of record classes), or to
+    dicts of values of the declared types if it has no record class.
+    """
+    if has_record_class(type_):
+        return record_class(type_).row_parser(header)
+
+    positions = {name: position for position, name in enumerate(header)}
+    missing = [name for name in record_struct(type_).definition if name not in positions]
+    if missing:
+        raise KeyError('fields {} are not in the header'.format(', '.join(missing)))
+    parsers = tuple((name, positions[name], value_parser(field_type))
+                    for name, field_type in record_struct(type_).definition.items())
+    return lambda row: {name: parse(row[position]) for name, position, parse in parsers}
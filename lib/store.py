@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+"""
+A local store of the outputs of pipeline steps.
+
+Outputs are stored in files named after the version hash of their step, so
+the store is addressed by the content of the computation that produced them.
+An index of the size, creation and last access time and number of hits of each
+entry is kept in `index.json`, and is used to evict entries when the store
+exceeds its budget, according to an eviction policy:
+
+- 'lru': least recently used entries first,
+- 'lfu': least frequently used entries first, then least recently used,
+- 'fifo': oldest entries first.
+
+An entry that is being added is evicted last.  Under 'lfu', entries are
+ordered by their hits plus the age of the store when they were added: the
+number of hits of the last entry evicted.  New entries thus start level with
+the entries that are about to be evicted, instead of below entries that had
+all their life to be hit.
+
+Entries that a run uses are pinned while it is in progress, and are not
+evicted until they are unpinned.
+"""
+
+from collections import Counter
+from collections.abc import Mapping
+import json
+import os
+import pickle
+from tempfile import mkstemp
+from threading import Lock
+from time import time
+from typing import Dict, Iterable, Iterator, Optional
+
+INDEX_FILENAME = 'index.json'
+RESULT_FILE_EXTENSION = '.pickle'
+
+_EVICTION_ORDERS = {
+    'lru': lambda entry: entry['accessed'],
+    'lfu': lambda entry: (entry['hits'] + entry.get('age', 0), entry['accessed']),
+    'fifo': lambda entry: entry['created'],
+}
+
+
+class StoredOutputs(Mapping):
+    """The outputs of a step in a `ResultStore`, which are only loaded when first accessed."""
+
+    def __init__(self, path: str):
+        self._path = path
+        self._outputs = None
+
+    def _load(self) -> Dict:
+        if self._outputs is None:
+            with open(self._path, 'rb') as f:
+                self._outputs = pickle.load(f)
+        return self._outputs
+
+    @property
+    def loaded(self) -> bool:
+        return self._outputs is not None
+
+    def __getitem__(self, name: str):
+        return self._load()[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self._path)
+
+
+class ResultStore(object):
+    """A file-backed store of step outputs keyed by the version hashes of the steps."""
+
+    def __init__(self, directory: str, max_bytes: int=None, policy: str='lru'):
+        """
+        :param directory: the directory to store outputs and the index in.
+        :param max_bytes: the disk budget of the store, if any.
+        :param policy: the eviction policy: 'lru', 'lfu' or 'fifo'.
+        """
+        if policy not in _EVICTION_ORDERS:
+            raise ValueError('unknown eviction policy {}'.format(policy))
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        # The number of runs in progress that use each entry, by version hash.
+        self._pins = Counter()
+
+        os.makedirs(directory, exist_ok=True)
+        self._index = self._load_index()
+        self._age = max((entry.get('age', 0) for entry in self._index.values()), default=0)
+
+    def path(self, version_hash: str) -> str:
+        return os.path.join(self.directory, version_hash + RESULT_FILE_EXTENSION)
+
+    def _load_index(self) -> Dict[str, Dict]:
+        try:
+            with open(os.path.join(self.directory, INDEX_FILENAME)) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return {}
+        return {version_hash: entry for version_hash, entry in index.items()
+                if os.path.exists(self.path(version_hash))}
+
+    def _save_index(self):
+        fd, temporary_path = mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._index, f, sort_keys=True)
+        os.replace(temporary_path, os.path.join(self.directory, INDEX_FILENAME))
+
+    def __contains__(self, version_hash: str) -> bool:
+        return version_hash in self._index
+
+    def get(self, version_hash: str, pin: bool=False) -> Optional[StoredOutputs]:
+        """
+        Return the stored outputs of a step, or None and count a miss if there
+        are none.  With `pin`, the entry is pinned if there is one.
+        """
+        with self._lock:
+            entry = self._index.get(version_hash, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            entry['hits'] += 1
+            entry['accessed'] = time()
+            if pin:
+                self._pins[version_hash] += 1
+        return StoredOutputs(self.path(version_hash))
+
+    def write(self, version_hash: str, outputs: Dict) -> int:
+        """
+        Write the outputs of a step to their file, without adding them to the
+        index, and return the size of the file.  Processes that share the
+        directory of a store write outputs with this method and leave
+        indexing them to the process that owns the store.
+        """
+        fd, temporary_path = mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(dict(outputs), f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(temporary_path)
+            os.replace(temporary_path, self.path(version_hash))
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        return size
+
+    def add(self, version_hash: str, size: int, pin: bool=False):
+        """
+        Add outputs written with `write` to the index, then evict entries if
+        required.  With `pin`, the entry is pinned.
+        """
+        now = time()
+        with self._lock:
+            self._index[version_hash] = {'size': size, 'created': now, 'accessed': now, 'hits': 0,
+                                         'age': self._age}
+            if pin:
+                self._pins[version_hash] += 1
+            self._evict(version_hash)
+            self._save_index()
+
+    def put(self, version_hash: str, outputs: Dict, pin: bool=False):
+        """Store the outputs of a step, then evict entries if the store exceeds its budget."""
+        self.add(version_hash, self.write(version_hash, outputs), pin)
+
+    def unpin(self, version_hashes: Iterable[str]):
+        """Unpin entries pinned by `get` or `add`, evict entries if required and save the index."""
+        with self._lock:
+            self._pins.subtract(version_hashes)
+            self._pins = +self._pins
+            self._evict()
+            self._save_index()
+
+    def _evict(self, new_version_hash: str=None):
+        if self.max_bytes is None:
+            return
+
+        total = sum(entry['size'] for entry in self._index.values())
+        order = _EVICTION_ORDERS[self.policy]
+        for version_hash, entry in sorted(self._index.items(), key=lambda item: (
+                item[0] == new_version_hash, order(item[1]))):
+            if total <= self.max_bytes:
+                break
+            if self._pins[version_hash]:
+                continue
+            os.remove(self.path(version_hash))
+            del self._index[version_hash]
+            total -= entry['size']
+            if self.policy == 'lfu':
+                self._age = max(self._age, entry['hits'] + entry.get('age', 0))
+
+    def remove(self, version_hash: str):
+        with self._lock:
+            if self._index.pop(version_hash, None) is not None:
+                os.remove(self.path(version_hash))
+                self._save_index()
+
+    def flush(self):
+        """Save the access times and hit counts of entries to the index."""
+        with self._lock:
+            self._save_index()
+
+    @property
+    def size(self) -> int:
+        return sum(entry['size'] for entry in self._index.values())
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def stats(self) -> Dict:
+        return {
+            'entries': len(self._index),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+        }
@@ -2,16 +2,25 @@
 
 from abc import ABCMeta, abstractmethod
 from collections import namedtuple
+from hashlib import sha1
+from inspect import signature
+import json
+from threading import Lock
 from typing import Dict as DictType
-
-from common import get_hashable_dict
+from weakref import WeakValueDictionary
 
 
 Serialized = namedtuple('Serialized', ['data_type', 'contents'])
 deserializers = {}
 
+_interned_types = WeakValueDictionary()
+_interned_types_lock = Lock()
+
 
 def get_deserialized(contents):
+    if isinstance(contents, AbstractMezuriSerializable):
+        return contents
+
     s = Serialized(*contents)
     return deserializers[s.data_type].deserialize(s.contents)
 
@@ -44,6 +53,15 @@ class AbstractMezuriSerializable(metaclass=MezuriSerializableMeta):
     def dependencies(self):
         return NotImplemented
 
+    @property
+    def fingerprint(self) -> str:
+        """
+        A stable digest of the structure of this object, such that objects that
+        are equal have the same fingerprint.
+        """
+        return sha1(json.dumps(self.serialize(), sort_keys=True,
+                               separators=(',', ':')).encode()).hexdigest()
+
     @abstractmethod
     def __repr__(self):
         return NotImplemented
@@ -57,9 +75,82 @@ class AbstractMezuriSerializable(metaclass=MezuriSerializableMeta):
         return NotImplemented
 
 
-class MezuriBaseType(AbstractMezuriSerializable):
+class MezuriTypeMeta(MezuriSerializableMeta):
+    """
+    Metaclass for Mezuri types.  Types are hash-consed: constructing a type
+    with the same layout as an existing one, including the order of the fields
+    of Structs, returns the existing object.  Keyword arguments are bound to
+    the parameters of `__init__`, so that they are interned as the same
+    positional arguments.
+    """
+    def __call__(cls, *args, **kwargs):
+        if kwargs:
+            bound = signature(cls.__init__).bind(None, *args, **kwargs)
+            bound.apply_defaults()
+            args = bound.args[1:]
+        key = cls._intern_key(*args)
+        instance = _interned_types.get(key, None)
+        if instance is None:
+            with _interned_types_lock:
+                instance = _interned_types.get(key, None)
+                if instance is None:
+                    instance = super(MezuriTypeMeta, cls).__call__(*args)
+                    _interned_types[key] = instance
+        return instance
+
+
+def _layout(type_: AbstractMezuriSerializable) -> str:
+    return type_.layout if isinstance(type_, AbstractMezuriType) else type_.fingerprint
+
+
+class AbstractMezuriType(AbstractMezuriSerializable, metaclass=MezuriTypeMeta):
+    """
+    An abstract class for interned Mezuri types.  The hash, fingerprint and
+    layout of a type are computed once, when the type is first constructed.
+
+    Types are equal if they have the same fingerprint, which does not depend
+    on the order of the fields of Structs.  Their layout does: types with the
+    same layout are the same object.
+    """
+    data_type = 'ABSTRACT_TYPE'
+
+    @classmethod
+    @abstractmethod
+    def _intern_key(cls, *args):
+        return NotImplemented
+
+    def _set_structure(self, structure: str, layout: str=None):
+        self._fingerprint = sha1(structure.encode()).hexdigest()
+        self._layout = self._fingerprint if layout is None else sha1(layout.encode()).hexdigest()
+        self._hash = hash(self._fingerprint)
+
+    @property
+    def fingerprint(self) -> str:
+        return self._fingerprint
+
+    @property
+    def layout(self) -> str:
+        """A digest of the structure of this type that includes the order of Struct fields."""
+        return self._layout
+
+    def __eq__(self, other):
+        return self is other or (isinstance(other, AbstractMezuriType) and
+                                 self._fingerprint == other._fingerprint)
+
+    def __hash__(self):
+        return self._hash
+
+
+class MezuriBaseType(AbstractMezuriType):
     data_type = 'ABSTRACT_BASE'
 
+    @classmethod
+    def _intern_key(cls):
+        return cls,
+
+    def __init__(self):
+        self._set_structure(self.data_type)
+
     def serialize(self):
         return Serialized(self.data_type, None)
 
@@ -74,11 +165,8 @@ class MezuriBaseType(AbstractMezuriSerializable):
     def __repr__(self):
         return self.data_type
 
-    def __eq__(self, other):
-        return self.data_type == other.data_type
-
-    def __hash__(self):
-        return hash(self.data_type)
+    def __reduce__(self):
+        return type(self), ()
 
 
 class Int(MezuriBaseType):
@@ -101,11 +189,17 @@ class String(MezuriBaseType):
     data_type = 'STRING'
 
 
-class List(AbstractMezuriSerializable):
+class List(AbstractMezuriType):
     data_type = 'LIST'
 
+    @classmethod
+    def _intern_key(cls, element_type: AbstractMezuriSerializable):
+        return cls, _layout(element_type)
+
     def __init__(self, element_type: AbstractMezuriSerializable):
         self.element_type = element_type
+        self._set_structure('{}[{}]'.format(self.data_type, element_type.fingerprint),
+                            '{}[{}]'.format(self.data_type, _layout(element_type)))
 
     def serialize(self):
         return Serialized(self.data_type, self.element_type.serialize())
@@ -121,23 +215,29 @@ class List(AbstractMezuriSerializable):
     def __repr__(self):
         return '[{}]'.format(repr(self.element_type))
 
-    def __eq__(self, other):
-        return (self.data_type == other.data_type and
-                self.element_type == other.element_type)
-
-    def __hash__(self):
-        return hash((self.element_type,))
+    def __reduce__(self):
+        return type(self), (self.element_type,)
 
 
 class Stream(List):
     data_type = 'STREAM'
 
 
-class Struct(AbstractMezuriSerializable):
+class Struct(AbstractMezuriType):
     data_type = 'STRUCT'
 
+    @classmethod
+    def _intern_key(cls, definition: DictType[str, AbstractMezuriSerializable]):
+        return cls, tuple((k, _layout(v)) for k, v in definition.items())
+
     def __init__(self, definition: DictType[str, AbstractMezuriSerializable]):
-        self.definition = definition
+        self.definition = dict(definition)
+        self._set_structure(
+            '{}{{{}}}'.format(self.data_type, ','.join(
+                '{}:{}'.format(json.dumps(k), v.fingerprint)
+                for k, v in sorted(self.definition.items()))),
+            '{}{{{}}}'.format(self.data_type, ','.join(
+                '{}:{}'.format(json.dumps(k), _layout(v)) for k, v in self.definition.items())))
 
     def serialize(self):
         return Serialized(self.data_type,
@@ -158,9 +258,22 @@ class Struct(AbstractMezuriSerializable):
         return '{{{}}}'.format(', '.join('{}: {}'.format(k, repr(v))
                                          for k, v in self.definition.items()))
 
-    def __eq__(self, other):
-        return (self.data_type == other.data_type and
-                self.definition == other.definition)
+    def __reduce__(self):
+        return type(self), (self.definition,)
 
-    def __hash__(self):
-        return hash(get_hashable_dict(self.definition))
+
+def is_projection(type_: AbstractMezuriSerializable, of_type: AbstractMezuriSerializable) -> bool:
+    """
+    Whether values of `of_type` can be used as values of `type_` by ignoring
+    fields: the types are equal, or they are Structs, or Lists or Streams of
+    Structs, and every field of `type_` is a field of `of_type` of the same type.
+    """
+    if type_ == of_type:
+        return True
+    if isinstance(type_, List):
+        return type(of_type) is type(type_) and is_projection(type_.element_type,
+                                                              of_type.element_type)
+    if isinstance(type_, Struct) and isinstance(of_type, Struct):
+        return all(of_type.definition.get(name, None) == field_type
+                   for name, field_type in type_.definition.items())
+    return False
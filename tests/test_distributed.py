@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""
+Tests of distributed execution on worker processes of the local host: a
+normal run, and the retry of steps that fail, whose worker dies, or whose
+worker does not reply in time.
+"""
+
+import os
+import socket
+import time
+
+import pytest
+
+from lib import PipelineError
+from lib.declarations import OperatorProxyFactory, SourceProxyFactory
+from lib.distributed import Coordinator
+from lib.pipelines import Pipeline, PipelineStep
+from lib.store import ResultStore
+import lib.types as mezuri_types
+
+# The directory in which components record their first attempts, so that
+# they behave differently when they are retried on another worker process.
+ATTEMPTS_DIRECTORY_VARIABLE = 'MEZURI_TEST_ATTEMPTS'
+
+ROWS = mezuri_types.List(mezuri_types.Struct({'id': mezuri_types.Int()}))
+
+
+def _first_attempt(name: str) -> bool:
+    path = os.path.join(os.environ[ATTEMPTS_DIRECTORY_VARIABLE], name)
+    if os.path.exists(path):
+        return False
+    open(path, 'w').close()
+    return True
+
+
+class Numbers(object):
+    def rows(self):
+        return [{'id': i} for i in range(10)]
+
+
+class Double(object):
+    def apply(self, rows):
+        return [{'id': 2 * row['id']} for row in rows]
+
+
+class FailsOnce(Double):
+    def apply(self, rows):
+        if _first_attempt('fails'):
+            raise ValueError('first attempt')
+        return super().apply(rows)
+
+
+class DiesOnce(Double):
+    def apply(self, rows):
+        if _first_attempt('dies'):
+            os._exit(1)
+        return super().apply(rows)
+
+
+class HangsOnce(Double):
+    def apply(self, rows):
+        if _first_attempt('hangs'):
+            time.sleep(60)
+        return super().apply(rows)
+
+
+class AlwaysFails(Double):
+    def apply(self, rows):
+        raise ValueError('always')
+
+
+CLASSES = {cls.__name__: cls for cls in (Numbers, Double, FailsOnce, DiesOnce, HangsOnce,
+                                         AlwaysFails)}
+
+
+def _resolve(proxy) -> type:
+    return CLASSES[proxy.name]
+
+
+def _pipeline(operator_name: str) -> Pipeline:
+    source = SourceProxyFactory('http://registry', 'Numbers', '0.0.1')
+    source._specs = {'definition': {'class': 'Numbers'}, 'iopDeclaration': {
+        'rows': {'uri': 'memory://numbers', 'query': 'read', 'output': {'rows': ROWS.serialize()}}}}
+    operator = OperatorProxyFactory('http://registry', operator_name, '0.0.1')
+    operator._specs = {'definition': {'class': operator_name}, 'iopDeclaration': {
+        'parameters': {},
+        'methods': {'apply': {'input': {'rows': ROWS.serialize()},
+                              'output': {'rows': ROWS.serialize()}}}}}
+
+    source_step = PipelineStep()
+    with source_step.context():
+        source.rows()
+    step = PipelineStep()
+    with step.context():
+        operator().apply(rows=source_step.output['rows'])
+    return Pipeline(step)
+
+
+@pytest.fixture
+def coordinator(tmp_path, monkeypatch):
+    attempts = tmp_path / 'attempts'
+    attempts.mkdir()
+    monkeypatch.setenv(ATTEMPTS_DIRECTORY_VARIABLE, str(attempts))
+    with Coordinator(_resolve, ResultStore(str(tmp_path / 'store')), worker_timeout=30,
+                     task_timeout=10) as coordinator:
+        yield coordinator
+
+
+def _output(run) -> list:
+    return list(run.output['rows'])
+
+
+def test_run(coordinator):
+    coordinator.start_local_workers(2)
+    run = coordinator.run(_pipeline('Double'))
+    assert _output(run) == [{'id': 2 * i} for i in range(10)]
+    assert len(run.timings) == 2
+
+
+def test_retry_after_failed_step(coordinator):
+    coordinator.start_local_workers(2)
+    assert _output(coordinator.run(_pipeline('FailsOnce'))) == [{'id': 2 * i} for i in range(10)]
+
+
+def test_retry_after_worker_dies(coordinator):
+    processes = coordinator.start_local_workers(2)
+    assert _output(coordinator.run(_pipeline('DiesOnce'))) == [{'id': 2 * i} for i in range(10)]
+    assert sum(process.exitcode == 1 for process in processes) == 1
+
+
+def test_retry_after_task_timeout(coordinator):
+    coordinator.task_timeout = 2
+    coordinator.start_local_workers(2)
+    start = time.perf_counter()
+    assert _output(coordinator.run(_pipeline('HangsOnce'))) == [{'id': 2 * i} for i in range(10)]
+    assert time.perf_counter() - start < 30
+
+
+def test_step_that_always_fails(coordinator):
+    coordinator.start_local_workers(2)
+    with pytest.raises(PipelineError, match='always'):
+        coordinator.run(_pipeline('AlwaysFails'))
+
+
+def test_silent_connection_does_not_block_workers(coordinator):
+    with socket.create_connection(coordinator.address):
+        coordinator.start_local_workers(1)
+        assert _output(coordinator.run(_pipeline('Double'))) == [{'id': 2 * i}
+                                                                 for i in range(10)]
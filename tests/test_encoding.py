@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""Tests for the compact binary encoding of Mezuri types in `lib.encoding`."""
+
+import pytest
+
+from lib.encoding import MAGIC, EncodingError, decode, encode, read_fingerprint
+import lib.types as mezuri_types
+
+ROW = mezuri_types.Struct({
+    'id': mezuri_types.Int(),
+    'name': mezuri_types.String(),
+    'score': mezuri_types.Double(),
+    'flag': mezuri_types.Bool(),
+    'when': mezuri_types.Datetime(),
+})
+
+TYPES = [
+    mezuri_types.Int(),
+    mezuri_types.String(),
+    mezuri_types.List(mezuri_types.Double()),
+    mezuri_types.Stream(ROW),
+    ROW,
+    mezuri_types.Struct({}),
+    mezuri_types.Struct({'nested': ROW, 'rows': mezuri_types.List(ROW), 'ünïcode': ROW}),
+]
+
+
+def _wide_struct(num_fields: int) -> mezuri_types.Struct:
+    return mezuri_types.Struct({'field_{}'.format(i): mezuri_types.List(ROW)
+                                for i in range(num_fields)})
+
+
+@pytest.mark.parametrize('type_', TYPES, ids=repr)
+def test_round_trip(type_):
+    data = encode(type_)
+    assert data.startswith(MAGIC)
+    assert read_fingerprint(data) == type_.fingerprint
+    decoded = decode(data)
+    assert decoded is type_
+    assert decoded.serialize() == type_.serialize()
+
+
+@pytest.mark.parametrize('type_', TYPES, ids=repr)
+def test_matches_serialize_and_deserialize(type_):
+    serialized = type_.serialize()
+    assert decode(encode(type_)) is mezuri_types.get_deserialized(serialized)
+    assert decode(encode(mezuri_types.get_deserialized(serialized))).serialize() == serialized
+
+
+def test_keeps_field_order():
+    reordered = mezuri_types.Struct(dict(reversed(list(ROW.definition.items()))))
+    decoded = decode(encode(reordered))
+    assert list(decoded.definition) == list(reordered.definition)
+    assert decoded == ROW
+
+
+def test_shared_subtrees_are_stored_once():
+    narrow, wide = _wide_struct(2), _wide_struct(100)
+    # Each further field only adds a reference to the shared List(ROW) subtree
+    # and the index of its name, which is at most a few bytes.
+    per_field = (len(encode(wide)) - len(encode(narrow))) / 98
+    assert per_field < len('field_99') + 8
+    assert decode(encode(wide)) is wide
+
+
+def test_decoded_shared_subtrees_are_one_object():
+    decoded = decode(encode(_wide_struct(10)))
+    element_types = {id(field_type) for field_type in decoded.definition.values()}
+    assert len(element_types) == 1
+
+
+@pytest.mark.parametrize('type_', TYPES, ids=repr)
+def test_rejects_truncated_data(type_):
+    data = encode(type_)
+    for length in range(len(data)):
+        with pytest.raises(EncodingError):
+            decode(data[:length])
+
+
+@pytest.mark.parametrize('type_', TYPES, ids=repr)
+def test_rejects_changed_data(type_):
+    data = encode(type_)
+    for position in range(len(data)):
+        for mask in (0x01, 0x80, 0xff):
+            changed = bytearray(data)
+            changed[position] ^= mask
+            with pytest.raises(EncodingError):
+                decode(bytes(changed))
+
+
+def test_rejects_trailing_data():
+    with pytest.raises(EncodingError):
+        decode(encode(ROW) + b'\x00')
+
+
+def test_rejects_other_data():
+    with pytest.raises(EncodingError):
+        read_fingerprint(b'{"data_type": "INT"}')
+    with pytest.raises(EncodingError):
+        decode(b'')
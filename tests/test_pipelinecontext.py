@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+"""
+Tests that pipeline step contexts are isolated between threads and asyncio
+tasks, which build pipelines concurrently, and that they can be nested.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import random
+
+import pytest
+
+from lib import PipelineError
+from lib.declarations import OperatorProxyFactory, SourceProxyFactory
+from lib.pipelines import Pipeline, PipelineStep
+import lib.types as mezuri_types
+
+NUM_PIPELINES = 2000
+WIDTH = 4
+
+ROWS = mezuri_types.List(mezuri_types.Struct({'id': mezuri_types.Int(),
+                                              'name': mezuri_types.String()}))
+
+
+def _source() -> SourceProxyFactory:
+    source = SourceProxyFactory('http://registry', 'source', '0.0.1')
+    source._specs = {'definition': {'class': 'Source'}, 'iopDeclaration': {
+        'rows': {'uri': 'file://rows.csv', 'query': 'read', 'output': {'rows': ROWS.serialize()}}}}
+    return source
+
+
+def _operator(name: str, inputs) -> OperatorProxyFactory:
+    operator = OperatorProxyFactory('http://registry', name, '0.0.1')
+    operator._specs = {'definition': {'class': name}, 'iopDeclaration': {
+        'parameters': {},
+        'methods': {'apply': {'input': {input_name: ROWS.serialize() for input_name in inputs},
+                              'output': {'rows': ROWS.serialize()}}}}}
+    return operator
+
+
+SOURCE = _source()
+TRANSFORM = _operator('transform', ['rows'])
+JOIN = _operator('join', ['left', 'right'])
+
+
+def _wide_pipeline(width: int=WIDTH) -> Pipeline:
+    """A source read by `width` transforms whose outputs are joined pairwise."""
+    source_step = PipelineStep()
+    with source_step.context():
+        SOURCE.rows()
+
+    branches = []
+    for _ in range(width):
+        step = PipelineStep()
+        with step.context():
+            TRANSFORM().apply(rows=source_step.output['rows'])
+        branches.append(step)
+
+    while len(branches) > 1:
+        joined = []
+        for left, right in zip(branches[::2], branches[1::2]):
+            step = PipelineStep()
+            with step.context():
+                JOIN().apply(left=left.output['rows'], right=right.output['rows'])
+            joined.append(step)
+        branches = joined
+    return Pipeline(branches[0])
+
+
+async def _async_pipeline() -> Pipeline:
+    """A source and a transform, whose contexts are left open across awaits."""
+    source_step = PipelineStep()
+    with source_step.context():
+        await asyncio.sleep(random.random() / 1000)
+        SOURCE.rows()
+        await asyncio.sleep(random.random() / 1000)
+
+    step = PipelineStep()
+    with step.context():
+        await asyncio.sleep(0)
+        TRANSFORM().apply(rows=source_step.output['rows'])
+    return Pipeline(step)
+
+
+def _assert_well_formed(pipeline: Pipeline, num_steps: int):
+    steps = pipeline.steps()
+    assert len(steps) == num_steps
+    for step in steps:
+        assert len([call for call in step._method_calls if call.method != '__init__']) == 1
+
+
+def test_threads():
+    expected = _wide_pipeline().version_hash()
+    with ThreadPoolExecutor(16) as pool:
+        pipelines = list(pool.map(lambda _: _wide_pipeline(), range(NUM_PIPELINES)))
+
+    assert {pipeline.version_hash() for pipeline in pipelines} == {expected}
+    for pipeline in pipelines:
+        _assert_well_formed(pipeline, 2 * WIDTH)
+
+
+def test_asyncio_tasks():
+    async def build_all():
+        return await asyncio.gather(*(_async_pipeline() for _ in range(NUM_PIPELINES)))
+
+    expected = asyncio.run(_async_pipeline()).version_hash()
+    pipelines = asyncio.run(build_all())
+
+    assert {pipeline.version_hash() for pipeline in pipelines} == {expected}
+    for pipeline in pipelines:
+        _assert_well_formed(pipeline, 2)
+
+
+def test_nested_contexts():
+    outer = PipelineStep()
+    with outer.context():
+        inner = PipelineStep()
+        with inner.context():
+            SOURCE.rows()
+        TRANSFORM().apply(rows=inner.output['rows'])
+
+    _assert_well_formed(Pipeline(outer), 2)
+    assert Pipeline(outer).steps() == [inner, outer]
+
+
+def test_calls_outside_a_context():
+    with pytest.raises(PipelineError):
+        SOURCE.rows()
+
+    with ThreadPoolExecutor(1) as pool:
+        step = PipelineStep()
+        with step.context():
+            # Contexts entered in a thread do not apply to other threads.
+            future = pool.submit(SOURCE.rows)
+            SOURCE.rows()
+        with pytest.raises(PipelineError):
+            future.result()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""Tests for saving and loading compiled pipeline plans in `lib.plans`."""
+
+import io
+import json
+import zlib
+
+import pytest
+
+from lib.declarations import OperatorProxyFactory, SourceProxyFactory
+from lib.encoding import EncodingError
+from lib.pipelines import Pipeline, PipelineStep
+from lib.plans import MAGIC, decode_plan, encode_plan
+import lib.types as mezuri_types
+
+DEPTH = 3000
+
+ROWS = mezuri_types.List(mezuri_types.Struct({'id': mezuri_types.Int()}))
+
+
+def _chain(depth: int) -> Pipeline:
+    source = SourceProxyFactory('http://registry', 'source', '0.0.1')
+    source._specs = {'definition': {'class': 'Source'}, 'iopDeclaration': {
+        'rows': {'uri': 'file://rows.csv', 'query': 'read', 'output': {'rows': ROWS.serialize()}}}}
+    operator = OperatorProxyFactory('http://registry', 'operator', '0.0.1')
+    operator._specs = {'definition': {'class': 'Operator'}, 'iopDeclaration': {
+        'parameters': {},
+        'methods': {'apply': {'input': {'rows': ROWS.serialize()},
+                              'output': {'rows': ROWS.serialize()}}}}}
+
+    step = PipelineStep()
+    with step.context():
+        source.rows()
+    for _ in range(depth):
+        prev_step, step = step, PipelineStep()
+        with step.context():
+            operator().apply(rows=prev_step.output['rows'])
+    return Pipeline(step)
+
+
+def _round_trip(pipeline: Pipeline, verify: bool=False) -> Pipeline:
+    file = io.BytesIO()
+    pipeline.save(file)
+    file.seek(0)
+    return Pipeline.load(file, verify)
+
+
+def test_deep_chain_round_trip():
+    pipeline = _chain(DEPTH)
+    loaded = _round_trip(pipeline, verify=True)
+    assert loaded == pipeline
+    assert len(loaded.steps()) == DEPTH + 1
+    assert loaded != _chain(DEPTH - 1)
+
+
+def _encode_body(plan) -> bytes:
+    return MAGIC + zlib.compress(json.dumps(plan).encode())
+
+
+def test_rejects_empty_plan():
+    with pytest.raises(EncodingError):
+        decode_plan(MAGIC + zlib.compress(b'{}'))
+
+
+def test_rejects_component_index_out_of_range():
+    plan = json.loads(zlib.decompress(encode_plan(_chain(2))[len(MAGIC):]))
+    plan['steps'][-1]['component'] = len(plan['components'])
+    with pytest.raises(EncodingError):
+        decode_plan(_encode_body(plan))
+
+
+@pytest.mark.parametrize('plan', [[], {'types': [], 'components': [], 'steps': [[]]},
+                                  {'types': [], 'components': [['operator']], 'steps': []}])
+def test_rejects_malformed_plans(plan):
+    with pytest.raises(EncodingError):
+        decode_plan(_encode_body(plan))